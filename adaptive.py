@@ -0,0 +1,167 @@
+import json
+import os
+
+# the rates the controller tunes, as named in the config
+RATES = ("mutate_chance", "retain_percentage", "random_select_chance")
+
+
+def _improvement(before, after):
+    """Returns the relative decrease from before to after, 0 if unknown."""
+    if before is None or before <= 0:
+        return 0.0
+    return (before - after) / before
+
+
+def truncate_log(filename, generation):
+    """
+    Removes the decisions logged after a generation from a log,
+    e.g. those after the checkpoint a run resumes from.
+
+    filename: the name of the log
+    generation: the last generation whose decisions are kept
+    """
+    if not os.path.exists(filename):
+        return
+    with open(filename) as log_file:
+        lines = [line for line in log_file
+                 if line.strip() and json.loads(line)["generation"] <= generation]
+    with open(filename, "w") as log_file:
+        log_file.writelines(lines)
+
+
+class RateController():
+    """
+    Tunes the mutation and selection rates of a population while it evolves.
+
+    Every window generations the relative improvement of the best fitness
+    and of the mean grade over the window, and the diversity of the
+    population are judged:
+
+    explore: if both stagnated or the diversity collapsed, the
+             mutate chance and the random select chance are raised and the
+             selection is loosened by retaining more individuals
+    exploit: if either improved, the selection is tightened by
+             retaining fewer individuals and selecting fewer at random,
+             the mutate chance falls back towards its configured value
+
+    Rates change by a factor per decision and stay between their configured
+    value divided and multiplied by max_change.
+    """
+
+    def __init__(self, mutate_chance, retain_percentage, random_select_chance,
+                 window=20, factor=1.5, max_change=4, min_improvement=0.001,
+                 diversity_threshold=0.05, log=None):
+        """
+        Creates the controller.
+
+        mutate_chance: the configured mutate chance
+        retain_percentage: the configured retain percentage
+        random_select_chance: the configured random select chance
+        window: the number of generations between decisions
+        factor: how much a decision changes a rate
+        max_change: how far the rates may move away from their configured values
+        min_improvement: the relative improvement over a window below which
+                         the evolution counts as stagnating
+        diversity_threshold: the diversity below which the population counts
+                             as collapsed, see Population.spread
+        log: optional file to which every decision is written as a JSON line
+        """
+        self.base = dict(mutate_chance=float(mutate_chance),
+                         retain_percentage=float(retain_percentage),
+                         random_select_chance=float(random_select_chance))
+        self.rates = dict(self.base)
+        self.window = max(1, int(window))
+        self.factor = float(factor)
+        self.max_change = float(max_change)
+        self.min_improvement = float(min_improvement)
+        self.diversity_threshold = float(diversity_threshold)
+        self.log = log
+        self.generations = 0
+        # best fitness and mean grade of the window before
+        self.last_best = None
+        self.last_mean = None
+        self.best = None
+        self.grades = 0.0
+
+    def __repr__(self):
+        return " ".join("{}: {:.4f}".format(name, self.rates[name]) for name in RATES)
+
+    def getstate(self):
+        """Returns the rates and the progress of the current window as a dict."""
+        return dict(rates=self.rates, generations=self.generations,
+                    last_best=self.last_best, last_mean=self.last_mean,
+                    best=self.best, grades=self.grades)
+
+    def setstate(self, state):
+        """
+        Restores a state returned by getstate.
+
+        state: the state to restore
+        """
+        self.rates = dict(state["rates"])
+        self.generations = state["generations"]
+        self.last_best = state["last_best"]
+        self.last_mean = state["last_mean"]
+        self.best = state["best"]
+        self.grades = state["grades"]
+
+    def _scale(self, name, factor):
+        """Multiplies a rate by factor, keeping it within its bounds."""
+        base = self.base[name]
+        low = base / self.max_change
+        high = min(base * self.max_change, 1.0)
+        self.rates[name] = min(max(self.rates[name] * factor, low), high)
+
+    def update(self, generation, grade, best_fitness, diversity=None):
+        """
+        Adds the results of a generation and adapts the rates at the end
+        of every window.
+
+        Returns the decision as a dictionary if one was made, else None.
+        The new rates are in the rates attribute.
+
+        generation: the number of the generation
+        grade: the grade of the generation
+        best_fitness: the best fitness of the generation, None if unknown
+        diversity: the diversity of the generation, None if unknown
+        """
+        if best_fitness is None:
+            return None
+        if self.best is None or best_fitness < self.best:
+            self.best = best_fitness
+        if self.last_best is None:
+            self.last_best = self.best
+        self.generations += 1
+        self.grades += grade
+        if self.generations % self.window:
+            return None
+
+        mean = self.grades / self.window
+        self.grades = 0.0
+        improvement = max(_improvement(self.last_best, self.best),
+                          _improvement(self.last_mean, mean))
+        self.last_best = self.best
+        self.last_mean = mean
+        collapsed = diversity is not None and diversity < self.diversity_threshold
+        if collapsed or improvement < self.min_improvement:
+            action = "explore"
+            reason = "low diversity" if collapsed else "stagnation"
+            self._scale("mutate_chance", self.factor)
+            self._scale("random_select_chance", self.factor)
+            self._scale("retain_percentage", self.factor)
+        else:
+            action = "exploit"
+            reason = "improving"
+            # back towards the configured value, not below it
+            self.rates["mutate_chance"] = max(self.rates["mutate_chance"] / self.factor,
+                                              min(self.base["mutate_chance"],
+                                                  self.rates["mutate_chance"]))
+            self._scale("random_select_chance", 1 / self.factor)
+            self._scale("retain_percentage", 1 / self.factor)
+        decision = dict(self.rates, generation=generation, action=action, reason=reason,
+                        best_fitness=self.best, grade=mean, improvement=improvement,
+                        diversity=diversity)
+        if self.log:
+            self.log.write(json.dumps(decision, sort_keys=True) + "\n")
+            self.log.flush()
+        return decision
@@ -0,0 +1,282 @@
+import numpy as np
+from population import Population
+from track import Track, Vector, simulate_batch
+from map import Point
+from stats import stats
+
+
+class ArrayPopulation(Population):
+    """
+    A population of tracks stored as padded NumPy arrays.
+
+    Instead of a list of Track objects every attribute of the tracks is
+    kept in one array with a row per track:
+
+    positions: (n, max_length, 2) positions, padded with zeros
+    accelerations: (n, max_length, 2) acceleration vectors, padded with zeros
+    velocities: (n, 2) final velocity vectors
+    lengths: (n,) number of positions of each track
+    collisions: (n,) collision flags
+
+    Fitness, sorting, selection and pairing for the crossover are done on
+    these arrays. Track objects are only created where a track has to be
+    simulated or when the tracks attribute is read.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.positions = np.zeros((0, 1, 2), dtype=np.int64)
+        self.accelerations = np.zeros((0, 1, 2), dtype=np.int64)
+        self.velocities = np.zeros((0, 2), dtype=np.int64)
+        self.lengths = np.zeros(0, dtype=np.int64)
+        self.collisions = np.zeros(0, dtype=bool)
+        super().__init__(*args, **kwargs)
+
+    def __len__(self):
+        return len(self.lengths)
+
+    @property
+    def tracks(self):
+        """The population as Track objects, best individuals first after evolve."""
+        return [self.track(i) for i in range(len(self))]
+
+    @tracks.setter
+    def tracks(self, tracks):
+        self._store(tracks)
+
+    def _allocate(self, size, max_length):
+        """Returns empty arrays for size tracks of at most max_length positions."""
+        return (np.zeros((size, max_length, 2), dtype=np.int64),
+                np.zeros((size, max_length, 2), dtype=np.int64),
+                np.zeros((size, 2), dtype=np.int64),
+                np.zeros(size, dtype=np.int64),
+                np.zeros(size, dtype=bool))
+
+    def _store(self, tracks, rows=None):
+        """
+        Packs Track objects into the arrays.
+
+        tracks: the Track objects
+        rows: the rows to overwrite, by default the arrays are replaced
+        """
+        if rows is None:
+            max_length = max([len(track.positions) for track in tracks] + [1])
+            (self.positions, self.accelerations, self.velocities,
+             self.lengths, self.collisions) = self._allocate(len(tracks), max_length)
+            rows = range(len(tracks))
+        for row, track in zip(rows, tracks):
+            length = len(track.positions)
+            self.positions[row, :length] = track.positions
+            self.accelerations[row, :length] = track.acceleration_vectors
+            self.velocities[row] = track.velocity_vector
+            self.lengths[row] = length
+            self.collisions[row] = track.collision
+
+    def track(self, row):
+        """
+        Unpacks a single row into a Track object.
+
+        row: the index of the track
+        """
+        length = self.lengths[row]
+        track = Track(self.map)
+        track.positions = [Point(*p) for p in self.positions[row, :length].tolist()]
+        track.acceleration_vectors = [Vector(*a) for a in
+                                      self.accelerations[row, :length].tolist()]
+        track.velocity_vector = Vector(*self.velocities[row].tolist())
+        track.collision = bool(self.collisions[row])
+        return track
+
+    def _store_states(self, states, rows):
+        """
+        Packs tracks returned by simulate into the arrays.
+
+        states: the simulated tracks
+        rows: the rows to overwrite
+        """
+        for row, (positions, accelerations, velocity, collision) in zip(rows, states):
+            length = len(positions)
+            self.positions[row, :length] = positions
+            self.accelerations[row, :length] = accelerations
+            self.velocities[row] = velocity
+            self.lengths[row] = length
+            self.collisions[row] = collision
+
+    def simulate(self, jobs):
+        """
+        Simulates new tracks approximating the given positions, all of them
+        together in lockstep with simulate_batch.
+
+        Results are cached like in Population.crossover, only the tracks
+        missing from the cache are simulated.
+
+        Returns a list of (positions, accelerations, velocity, collision)
+        tuples with arrays of all positions and acceleration vectors.
+
+        jobs: list of (positions, prefix_row, prefix_length) tuples of
+              positions: (n, 2) array of positions to approximate
+              prefix_row: track whose beginning is copied instead of simulated
+              prefix_length: the number of positions to copy from prefix_row,
+                             these must not include its collision
+        """
+        states = [None] * len(jobs)
+        keys = [None] * len(jobs)
+        if self.cache.size > 0:
+            missing = []
+            for index, (positions, prefix_row, prefix_length) in enumerate(jobs):
+                keys[index] = (self.accelerations[prefix_row, :prefix_length].tobytes(),
+                               positions.tobytes())
+                states[index] = self.cache.get(keys[index])
+                if states[index] is None:
+                    missing.append(index)
+            stats.count("cache_hits", len(jobs) - len(missing))
+            stats.count("cache_misses", len(missing))
+        else:
+            missing = list(range(len(jobs)))
+        if not missing:
+            return states
+
+        lengths = np.array([len(jobs[index][0]) for index in missing], dtype=np.int64)
+        steps = np.zeros((len(missing), max(lengths.max(), 1), 2), dtype=np.int64)
+        starts = np.tile(np.array(self.map.start, dtype=np.int64), (len(missing), 1))
+        velocities = np.zeros((len(missing), 2), dtype=np.int64)
+        for j, index in enumerate(missing):
+            positions, prefix_row, prefix_length = jobs[index]
+            steps[j, :len(positions)] = positions
+            # continue where the copied prefix ends, like Track.copy_prefix
+            if prefix_length > 0:
+                starts[j] = self.positions[prefix_row, prefix_length - 1]
+            if prefix_length > 1:
+                velocities[j] = starts[j] - self.positions[prefix_row, prefix_length - 2]
+        new_positions, new_accelerations, counts, velocities, collisions = simulate_batch(
+            self.map, starts, velocities, steps, lengths, rng=self.rng)
+
+        start = np.array([self.map.start], dtype=np.int64)
+        no_acceleration = np.zeros((1, 2), dtype=np.int64)
+        for j, index in enumerate(missing):
+            _, prefix_row, prefix_length = jobs[index]
+            count = counts[j]
+            state = (np.concatenate((start, self.positions[prefix_row, :prefix_length],
+                                     new_positions[j, :count])),
+                     np.concatenate((no_acceleration,
+                                     self.accelerations[prefix_row, :prefix_length],
+                                     new_accelerations[j, :count])),
+                     tuple(velocities[j].tolist()), bool(collisions[j]))
+            if keys[index] is not None:
+                self.cache.put(keys[index], state)
+            states[index] = state
+        return states
+
+    def evolve(self):
+        """Evolves the population."""
+        stats.count("generations")
+        with stats.phase("grading"):
+            fitness = self.fitnesses(self.positions[np.arange(len(self)), self.lengths - 1],
+                                     self.lengths, self.collisions)
+            grade = self.grade(fitness)
+            self.best_fitness = float(fitness.min()) if len(fitness) else None
+            self.diversity = self.spread(fitness)
+        with stats.phase("sorting"):
+            elite, rest = self.select(fitness)
+
+        # randomly add other individuals to promote genetic diversity
+        with stats.phase("selection"):
+            lucky = rest[self.rng.numpy.random(len(rest)) < self.random_select_chance]
+            parents = np.concatenate((elite, lucky))
+            parents_length = len(parents)
+        if parents_length == 0:
+            # nothing to breed from, the population stays as it is
+            return grade
+
+        # mutate some individuals, the mutated tracks replace their parents
+        # before the crossover like in Population.evolve
+        with stats.phase("mutation"):
+            mutated = np.flatnonzero(self.rng.numpy.random(parents_length) < self.mutate_chance)
+            jobs = []
+            for i in mutated:
+                row = parents[i]
+                mutated_positions = self.positions[row, :self.lengths[row]].copy()
+                pos_to_mutate = self.rng.numpy.integers(len(mutated_positions))
+                mutated_positions[pos_to_mutate] = (
+                    self.rng.numpy.integers(self.map.size_x + 1),
+                    self.rng.numpy.integers(self.map.size_y + 1))
+                jobs.append((mutated_positions, 0, 0))
+            stats.count("mutations", len(mutated))
+
+        with stats.phase("simulation"):
+            states = self.simulate(jobs)
+
+        # parents move to the first rows, mutated tracks are packed into theirs
+        with stats.phase("packing"):
+            self._pack_parents(parents, states)
+            self._store_states(states, mutated)
+
+        desired_length = len(self) - parents_length
+        if parents_length == 1:
+            # nobody to pair with, the children are copies of the only parent
+            with stats.phase("crossover"):
+                for array in (self.positions, self.accelerations, self.velocities,
+                              self.lengths, self.collisions):
+                    array[1:] = array[0]
+                stats.count("children", desired_length)
+            return grade
+
+        # crossover parents to create children,
+        # pairing every male with a different female
+        with stats.phase("crossover"):
+            males = self.rng.numpy.integers(parents_length, size=desired_length)
+            females = (males + self.rng.numpy.integers(1, parents_length, size=desired_length)
+                       ) % parents_length
+            half_males = self.lengths[males] // 2
+            half_females = self.lengths[females] // 2
+            jobs = []
+            for male, female, half_male, half_female in zip(males, females,
+                                                            half_males, half_females):
+                prefix_length = min(half_male, self.lengths[male] - self.collisions[male])
+                child_positions = np.concatenate(
+                    (self.positions[male, prefix_length:half_male],
+                     self.positions[female, half_female:self.lengths[female]]))
+                jobs.append((child_positions, male, prefix_length))
+            stats.count("children", desired_length)
+
+        # all children are simulated together
+        with stats.phase("simulation"):
+            states = self.simulate(jobs)
+
+        with stats.phase("packing"):
+            self._widen(max([0] + [len(state[0]) for state in states]))
+            self._store_states(states, range(parents_length, len(self)))
+        return grade
+
+    def _pack_parents(self, parents, states):
+        """
+        Replaces the arrays by new ones holding the parents in the first rows.
+
+        parents: the rows of the parents
+        states: simulated tracks which are stored afterwards, the arrays
+                are made long enough for them
+        """
+        max_length = max([self.lengths[parents].max()] +
+                         [len(state[0]) for state in states])
+        arrays = self._allocate(len(self), max_length)
+        for new, old in zip(arrays, (self.positions, self.accelerations,
+                                     self.velocities, self.lengths,
+                                     self.collisions)):
+            if new.ndim == 3:
+                width = min(new.shape[1], old.shape[1])
+                new[:len(parents), :width] = old[parents, :width]
+            else:
+                new[:len(parents)] = old[parents]
+        (self.positions, self.accelerations, self.velocities,
+         self.lengths, self.collisions) = arrays
+
+    def _widen(self, max_length):
+        """
+        Pads the position and acceleration arrays to at least max_length.
+
+        max_length: the number of positions the arrays have to hold
+        """
+        missing = max_length - self.positions.shape[1]
+        if missing > 0:
+            padding = ((0, 0), (0, missing), (0, 0))
+            self.positions = np.pad(self.positions, padding)
+            self.accelerations = np.pad(self.accelerations, padding)
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+
+import argparse
+import configparser
+import csv
+import itertools
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+from map import Map
+from main import (population_class, population_arguments, convergence_detector,
+                  rate_controller)
+
+# columns of the results table
+FIELDS = ["job", "map", "overrides", "best_fitness", "grade", "generations",
+          "wall_time", "error"]
+
+# maps already loaded by this worker, keyed by the config values they depend on
+_maps = {}
+
+
+def parse_overrides(settings):
+    """
+    Expands --set arguments into all combinations of config overrides.
+
+    Returns a list of lists of (section, key, value) tuples.
+
+    settings: strings of the form Section.key=value1,value2,...
+    """
+    axes = []
+    for setting in settings:
+        name, separator, values = setting.partition("=")
+        section, dot, key = name.partition(".")
+        if not separator or not dot or not values:
+            raise Exception("Invalid override, expected Section.key=value[,value...]: "
+                            + setting)
+        axes.append([(section, key, value.strip()) for value in values.split(",")])
+    return [list(combination) for combination in itertools.product(*axes)]
+
+
+def format_overrides(overrides):
+    """Returns overrides as a string like Map.mutate_chance=0.02."""
+    return " ".join("{}.{}={}".format(*override) for override in overrides)
+
+
+def _load_map(config):
+    """Returns the map of a job, loading it only once per worker."""
+    distance_field = config.getboolean("Distance", "enabled", fallback=False)
+    cell_size = config.getint("Distance", "cell_size", fallback=0)
+    key = (config["Map"]["filename"], config["Map"]["max_acceleration"],
+           distance_field, cell_size)
+    if key not in _maps:
+        map = Map(config["Map"]["max_acceleration"], config["Map"]["filename"])
+        if distance_field:
+            map.use_distance_field(cell_size,
+                                   config.get("Distance", "cache_directory", fallback=""))
+        _maps[key] = map
+    return _maps[key]
+
+
+def _configure(config_file_name, map_file_name, overrides, seed):
+    """
+    Reads the base config and applies the overrides of a job.
+
+    config_file_name: the base config file
+    map_file_name: the map of the job
+    overrides: list of (section, key, value) tuples
+    seed: the seed of the job, unless the overrides set one
+    """
+    config = configparser.ConfigParser()
+    config.read(config_file_name)
+    config["Map"]["filename"] = map_file_name
+    config["Map"]["seed"] = str(seed)
+    for section, key, value in overrides:
+        if not config.has_section(section):
+            config.add_section(section)
+        config[section][key] = value
+    # the jobs already run in parallel and pool workers can't have children
+    config["Map"]["init_workers"] = "1"
+    return config
+
+
+def run_job(job):
+    """
+    Evolves a population for one map and one set of overrides.
+
+    Returns a row of the results table, errors are reported in the row
+    instead of stopping the whole batch. The jobs themselves are the unit
+    of parallelism, so a job always evolves a single population without
+    islands.
+
+    job: tuple of job number, base config file, map file, overrides and seed
+    """
+    number, config_file_name, map_file_name, overrides, seed = job
+    result = dict(job=number, map=map_file_name, overrides=format_overrides(overrides),
+                  best_fitness="", grade="", generations=0, wall_time=0, error="")
+    start = time.perf_counter()
+    try:
+        config = _configure(config_file_name, map_file_name, overrides, seed)
+        max_timesteps = int(config["Map"]["max_timesteps"])
+        map = _load_map(config)
+        population = population_class(config)(**population_arguments(config, map))
+        detector = convergence_detector(config)
+        controller = rate_controller(config)
+        for generation in range(1, max_timesteps + 1):
+            result["grade"] = population.evolve()
+            result["generations"] = generation
+            if controller and controller.update(generation, result["grade"],
+                                                population.best_fitness,
+                                                population.diversity):
+                population.set_rates(**controller.rates)
+            if detector.update(generation, result["grade"], population.best_fitness):
+                break
+        tracks = population.tracks
+        population.close()
+        result["best_fitness"] = min(population.fitness(track) for track in tracks)
+    except Exception:
+        result["error"] = traceback.format_exc().strip().splitlines()[-1]
+    result["wall_time"] = time.perf_counter() - start
+    return result
+
+
+def print_table(results, file=sys.stdout):
+    """Prints the results as an aligned table."""
+    rows = [FIELDS] + [[str(result[field]) if not isinstance(result[field], float)
+                        else "{:.3f}".format(result[field]) for field in FIELDS]
+                       for result in results]
+    widths = [max(len(row[column]) for row in rows) for column in range(len(FIELDS))]
+    for row in rows:
+        file.write("  ".join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip()
+                   + "\n")
+
+
+def main():
+    """Runs all combinations of maps and overrides and writes the results table."""
+    parser = argparse.ArgumentParser(description="Runs the evolution for many maps and"
+                                                 " configs on a shared process pool.")
+    parser.add_argument("--config_file", default="default.cfg",
+                        help="base config every job starts from")
+    parser.add_argument("--maps", nargs="+", required=True, help="map files to run")
+    parser.add_argument("--set", action="append", default=[], dest="settings",
+                        metavar="SECTION.KEY=VALUES",
+                        help="comma separated values for a config key, repeatable;"
+                             " all combinations are run")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="number of worker processes, 0 for one per CPU")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="seed of the first job, the following jobs count up")
+    parser.add_argument("--output", default="results.csv",
+                        help="file name of the CSV results table")
+    args = parser.parse_args()
+
+    if not os.path.isfile(args.config_file):
+        raise Exception("Config file " + args.config_file + " not found. Exiting.")
+    jobs = [(number, args.config_file, map_file_name, overrides, args.seed + number)
+            for number, (map_file_name, overrides) in enumerate(
+                itertools.product(args.maps, parse_overrides(args.settings)))]
+    workers = args.workers if args.workers > 0 else multiprocessing.cpu_count()
+    results = []
+    with multiprocessing.Pool(min(workers, len(jobs))) as pool:
+        for result in pool.imap_unordered(run_job, jobs):
+            results.append(result)
+            print("Finished job {}/{}: {} {}{}".format(
+                len(results), len(jobs), result["map"], result["overrides"],
+                " -- " + result["error"] if result["error"] else ""))
+    results.sort(key=lambda result: result["job"])
+    with open(args.output, "w", newline="") as output_file:
+        writer = csv.DictWriter(output_file, fieldnames=FIELDS)
+        writer.writeheader()
+        writer.writerows(results)
+    print_table(results)
+
+if __name__ == "__main__":
+    main()
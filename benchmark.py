@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import os
+import platform
+import random
+import tempfile
+import timeit
+import tracemalloc
+import numpy as np
+from map import Map, Point
+from track import Track, simulate_batch
+from intersect import do_intersect
+from population import Population
+from array_population import ArrayPopulation
+from rng import RandomStream
+from graphics import save_svg
+
+# generated maps and populations the benchmarks run on
+SIZES = {
+    "small":  dict(map_size=100,  walls=5,    max_acceleration=10,  population_size=100),
+    "medium": dict(map_size=1000, walls=500,  max_acceleration=50,  population_size=500),
+    "huge":   dict(map_size=5000, walls=5000, max_acceleration=100, population_size=2000),
+}
+
+def generate_map(map_size, walls, max_acceleration):
+    """
+    Generates a square map with random short walls inside.
+
+    map_size: edge length of the map
+    walls: number of walls inside the map
+    max_acceleration: the maximum acceleration allowed on the map
+    """
+    map = Map(max_acceleration)
+    corners = [Point(0, 0), Point(0, map_size), Point(map_size, map_size), Point(map_size, 0)]
+    for p, q in zip(corners, corners[1:] + corners[:1]):
+        map.add_line(p, q)
+    map.start = Point(map_size // 10, map_size // 10)
+    map.target = Point(map_size - map_size // 10, map_size - map_size // 10)
+    map.size_x = map.size_y = map_size
+    wall_length = max(2, map_size // 50)
+    while len(map.map) < walls + 4:
+        p = Point(random.randint(1, map_size - 1), random.randint(1, map_size - 1))
+        q = Point(min(max(p.x + random.randint(-wall_length, wall_length), 1), map_size - 1),
+                  min(max(p.y + random.randint(-wall_length, wall_length), 1), map_size - 1))
+        # keep start and target free
+        if any(abs(p.x - c.x) + abs(p.y - c.y) < 2 * wall_length
+               for c in (map.start, map.target)):
+            continue
+        map.add_line(p, q)
+    return map
+
+def save_text_map(map, filename):
+    """Writes a map in the text format."""
+    with open(filename, "w") as map_file:
+        for p, q in map.map:
+            map_file.write("w {} {} {} {}\n".format(p.x, p.y, q.x, q.y))
+        map_file.write("s {} {}\n".format(*map.start))
+        map_file.write("t {} {}\n".format(*map.target))
+
+def generate_population(map, population_size, seed, backend=Population):
+    """
+    Generates a population with few attempts per individual.
+
+    backend: the population class, Population or ArrayPopulation
+    """
+    return backend(map, population_size, distance_factor=1.0,
+                   collision_penalty=30, retain_percentage=0.2,
+                   random_select_chance=0.05, mutate_chance=0.02,
+                   max_init_attempts=20, rng=RandomStream(seed))
+
+def measure(function, ops, repeat, setup=None):
+    """
+    Times a function and records its peak memory usage.
+
+    function: the function to benchmark
+    ops: the number of operations one call of function performs
+    repeat: how often function is timed, the fastest call counts
+    setup: optional function whose result is passed to function,
+           it is called again before every call and not timed
+    """
+    arguments = lambda: () if setup is None else (setup(),)
+    timings = []
+    for _ in range(repeat):
+        call_arguments = arguments()
+        start = timeit.default_timer()
+        function(*call_arguments)
+        timings.append(timeit.default_timer() - start)
+    seconds = min(timings)
+    call_arguments = arguments()
+    tracemalloc.start()
+    function(*call_arguments)
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return dict(ops=ops, seconds=seconds, ops_per_sec=ops/seconds,
+                peak_memory=peak_memory)
+
+def benchmarks(size, out_directory):
+    """
+    Yields the name, function, number of operations and setup function,
+    see measure, of every benchmark for a size from SIZES.
+
+    size: the name of the size
+    out_directory: folder for the SVG files
+    """
+    parameters = SIZES[size]
+    map = generate_map(parameters["map_size"], parameters["walls"],
+                       parameters["max_acceleration"])
+    # every run of a benchmark gets the same random numbers
+    seed = random.getrandbits(64)
+    population = generate_population(map, parameters["population_size"], seed)
+    tracks = population.tracks
+
+    def random_point():
+        return Point(random.randint(0, parameters["map_size"]),
+                     random.randint(0, parameters["map_size"]))
+    segment_pairs = [((random_point(), random_point()), (random_point(), random_point()))
+                     for _ in range(10000)]
+    def intersect():
+        for p, q in segment_pairs:
+            do_intersect(p, q)
+    yield "do_intersect", intersect, len(segment_pairs), None
+
+    def check_collisions():
+        for track in tracks:
+            track.check_collisions()
+    yield ("check_collisions", check_collisions,
+           sum(len(track.positions) - 1 for track in tracks), None)
+
+    def approximate_positions():
+        rng = RandomStream(seed)
+        for track in tracks:
+            Track(map, rng).approximate_positions(track.positions)
+    yield "approximate_positions", approximate_positions, len(tracks), None
+
+    # the same tracks approximated in lockstep, as ArrayPopulation does
+    lengths = np.array([len(track.positions) for track in tracks], dtype=np.int64)
+    steps = np.zeros((len(tracks), lengths.max(), 2), dtype=np.int64)
+    for row, track in enumerate(tracks):
+        steps[row, :len(track.positions)] = track.positions
+    starts = np.tile(np.array(map.start, dtype=np.int64), (len(tracks), 1))
+    velocities = np.zeros((len(tracks), 2), dtype=np.int64)
+    yield ("simulate_batch",
+           lambda: simulate_batch(map, starts, velocities, steps, lengths,
+                                  rng=RandomStream(seed)),
+           len(tracks), None)
+
+    text_map = os.path.join(out_directory, "benchmark.map")
+    binary_map = os.path.join(out_directory, "benchmark.bmap")
+    save_text_map(map, text_map)
+    map.save_binary(binary_map)
+    yield ("load_text_map", lambda: Map(parameters["max_acceleration"], text_map),
+           len(map.map), None)
+    yield ("load_binary_map", lambda: Map(parameters["max_acceleration"], binary_map),
+           len(map.map), None)
+
+    for prefix, backend in (("", Population), ("array_", ArrayPopulation)):
+        generate = lambda backend=backend: generate_population(
+            map, parameters["population_size"], seed, backend)
+        yield prefix + "population_init", generate, parameters["population_size"], None
+        # every repetition evolves a fresh population from the same seed
+        yield prefix + "evolve", lambda population: population.evolve(), 1, generate
+
+    yield ("save_svg",
+           lambda: save_svg("benchmark.svg", map, tracks, 1.0, out_directory=out_directory),
+           1, None)
+
+def compare(results, baseline, tolerance):
+    """
+    Compares results with a previous run and returns the regressions.
+
+    results: the results of this run
+    baseline: the report of a previous run
+    tolerance: how much slower than the baseline a benchmark may be
+    """
+    previous = {(r["size"], r["benchmark"]): r for r in baseline["results"]}
+    regressions = []
+    for result in results:
+        old = previous.get((result["size"], result["benchmark"]))
+        if old is None:
+            continue
+        ratio = result["ops_per_sec"]/old["ops_per_sec"]
+        print("{:>6s} {:>22s}: {:>6.2f}x baseline".format(
+            result["size"], result["benchmark"], ratio))
+        if ratio < 1 - tolerance:
+            regressions.append(result)
+    return regressions
+
+def main():
+    """Runs the benchmarks and prints or saves the results as JSON."""
+    parser = argparse.ArgumentParser(description="Benchmarks the hot paths of the simulation.")
+    parser.add_argument("--sizes", nargs="+", choices=sorted(SIZES),
+                        default=["small", "medium"], help="map and population sizes to run")
+    parser.add_argument("--only", nargs="+", help="run only these benchmarks")
+    parser.add_argument("--repeat", type=int, default=3, help="timing repetitions")
+    parser.add_argument("--seed", type=int, default=0, help="seed for the generated fixtures")
+    parser.add_argument("--output", help="file name for the JSON results")
+    parser.add_argument("--baseline", help="JSON results of a previous run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="allowed slowdown compared to the baseline")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    results = []
+    with tempfile.TemporaryDirectory() as out_directory:
+        for size in args.sizes:
+            for name, function, ops, setup in benchmarks(size, out_directory):
+                if args.only and name not in args.only:
+                    continue
+                result = dict(size=size, benchmark=name,
+                              **measure(function, ops, args.repeat, setup))
+                results.append(result)
+                print("{:>6s} {:>22s}: {:>12.1f} ops/s {:>10.1f} KiB peak".format(
+                    size, name, result["ops_per_sec"], result["peak_memory"]/1024))
+    report = dict(python=platform.python_version(), numpy=np.__version__,
+                  seed=args.seed, repeat=args.repeat, results=results)
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(report, output_file, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.tolerance)
+        if regressions:
+            raise SystemExit("{} benchmarks regressed.".format(len(regressions)))
+
+if __name__ == "__main__":
+    main()
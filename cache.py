@@ -0,0 +1,59 @@
+from collections import OrderedDict
+
+
+class LRUCache():
+    """A bounded mapping which evicts the least recently used entries."""
+
+    def __init__(self, size):
+        """
+        Creates the cache.
+
+        size: the maximum number of entries, 0 disables the cache
+        """
+        self.size = int(size)
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self):
+        return "Entries: {}/{} Hits: {} Misses: {}".format(
+            len(self.entries), self.size, self.hits, self.misses)
+
+    def __len__(self):
+        return len(self.entries)
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        if lookups > 0:
+            return self.hits/lookups
+        else:
+            return 0
+
+    def get(self, key):
+        """
+        Returns the value stored for key or None.
+
+        key: a hashable key
+        """
+        value = self.entries.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        """
+        Stores a value, evicting the least recently used entry if necessary.
+
+        key: a hashable key
+        value: the value, must not be None
+        """
+        if self.size <= 0:
+            return
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
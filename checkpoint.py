@@ -0,0 +1,92 @@
+import os
+import json
+import numpy as np
+from array_population import ArrayPopulation
+from track import replay_track
+
+
+def _pack(population):
+    """
+    Returns the acceleration vectors of all tracks concatenated into one
+    array together with the lengths and collision flags of the tracks.
+
+    population: the population to pack
+    """
+    if isinstance(population, ArrayPopulation):
+        # the arrays are already there, only the padding has to go
+        mask = np.arange(population.accelerations.shape[1]) < population.lengths[:, None]
+        return (population.accelerations[mask], population.lengths,
+                population.collisions)
+    tracks = population.tracks
+    lengths = np.array([len(track.acceleration_vectors) for track in tracks])
+    accelerations = np.array([vector for track in tracks
+                              for vector in track.acceleration_vectors]).reshape(-1, 2)
+    collisions = np.array([track.collision for track in tracks], dtype=bool)
+    return accelerations, lengths, collisions
+
+
+def save_checkpoint(filename, population, generation, detector=None, controller=None):
+    """
+    Saves the state of a run.
+
+    Only the acceleration vectors and collision flags of the tracks are
+    stored together with the state of the random stream of the population,
+    everything else can be derived from them. The grades are not stored,
+    a resumed run reads them back from its GradeHistory file, only the
+    state of the stop criteria which depends on more than the grades and
+    the state of the rate controller are kept. The file is replaced atomically, so a killed process never leaves
+    a broken checkpoint.
+
+    filename: the name of the checkpoint file
+    population: the population to save
+    generation: the last finished generation
+    detector: the ConvergenceDetector of the run
+    controller: the RateController of the run, if the rates are adapted
+    """
+    accelerations, lengths, collisions = _pack(population)
+    directory = os.path.dirname(filename)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    temporary = filename + ".tmp"
+    with open(temporary, "wb") as checkpoint_file:
+        np.savez(checkpoint_file,
+                 accelerations=accelerations.astype(np.int32),
+                 lengths=lengths.astype(np.int32),
+                 collisions=collisions,
+                 generation=np.int64(generation),
+                 rng_state=np.array(json.dumps(population.rng.getstate())),
+                 detector_state=np.array(json.dumps(
+                     detector.getstate() if detector is not None else [])),
+                 controller_state=np.array(json.dumps(
+                     controller.getstate() if controller is not None else None)))
+    os.replace(temporary, filename)
+
+
+def load_checkpoint(filename, map, rng=None, detector=None, controller=None):
+    """
+    Loads a checkpoint and restores the state of the random stream,
+    of the stop criteria and of the rate controller.
+
+    Returns the rebuilt tracks and the last finished generation.
+
+    filename: the name of the checkpoint file
+    map: the map of the run
+    rng: the RandomStream of the population, continues where the saved
+         one stopped
+    detector: the ConvergenceDetector of the run
+    controller: the RateController of the run, if the rates are adapted
+    """
+    with np.load(filename) as checkpoint:
+        if rng is not None:
+            rng.setstate(json.loads(str(checkpoint["rng_state"])))
+        if detector is not None and "detector_state" in checkpoint.files:
+            detector.setstate(json.loads(str(checkpoint["detector_state"])))
+        if controller is not None and "controller_state" in checkpoint.files:
+            state = json.loads(str(checkpoint["controller_state"]))
+            if state is not None:
+                controller.setstate(state)
+        ends = np.cumsum(checkpoint["lengths"])
+        tracks = [replay_track(map, accelerations, collision) for accelerations, collision
+                  in zip(np.split(checkpoint["accelerations"], ends[:-1]),
+                         checkpoint["collisions"])]
+        return tracks, int(checkpoint["generation"])
@@ -0,0 +1,355 @@
+import os
+import time
+from collections import deque
+import numpy as np
+
+
+class RollingWindow():
+    """
+    The last values of a series with their mean, variance and maximum.
+
+    The values are kept in a ring buffer together with a running sum,
+    sum of squares and a monotonic queue of maximum candidates, so adding
+    a value and reading the statistics take constant (amortized) time.
+    """
+
+    def __init__(self, size):
+        """
+        Creates the window.
+
+        size: the number of values in the window
+        """
+        self.size = max(1, int(size))
+        self.values = np.zeros(self.size)
+        self.count = 0
+        self.sum = 0.0
+        self.squares = 0.0
+        # (index, value) pairs with decreasing values
+        self.maxima = deque()
+
+    def __len__(self):
+        return min(self.count, self.size)
+
+    @property
+    def full(self):
+        return self.count >= self.size
+
+    def push(self, value):
+        """
+        Adds a value, dropping the oldest one if the window is full.
+
+        value: the value to add
+        """
+        value = float(value)
+        slot = self.count % self.size
+        if self.full:
+            old = self.values[slot]
+            self.sum -= old
+            self.squares -= old * old
+        self.values[slot] = value
+        self.sum += value
+        self.squares += value * value
+        while self.maxima and self.maxima[-1][1] <= value:
+            self.maxima.pop()
+        self.maxima.append((self.count, value))
+        self.count += 1
+        while self.maxima[0][0] <= self.count - 1 - self.size:
+            self.maxima.popleft()
+
+    @property
+    def mean(self):
+        if len(self) == 0:
+            return 0
+        return self.sum/len(self)
+
+    @property
+    def variance(self):
+        if len(self) == 0:
+            return 0
+        # rounding errors of the running sums may push it slightly below 0
+        return max(self.squares/len(self) - self.mean * self.mean, 0.0)
+
+    @property
+    def maximum(self):
+        return self.maxima[0][1]
+
+
+class Plateau():
+    """Stops when no grade of the window is more than 1 above their mean."""
+
+    def __init__(self, window):
+        """
+        window: the number of generations to look at
+        """
+        self.window = RollingWindow(window)
+
+    def check(self, generation, grade, best_fitness):
+        """
+        Adds the results of a generation and returns the reason to stop
+        or None.
+
+        generation: the number of the generation
+        grade: the grade of the generation
+        best_fitness: the best fitness of the generation, None if unknown
+        """
+        self.window.push(grade)
+        # checking starts once more grades than the window holds were seen
+        if self.window.count > self.window.size and self.window.maximum - self.window.mean <= 1:
+            return "Population isn't changing anymore"
+        return None
+
+
+class VarianceThreshold():
+    """Stops when the variance of the grades of the window is small enough."""
+
+    def __init__(self, window, threshold):
+        """
+        window: the number of generations to look at
+        threshold: the variance below which the population counts as converged
+        """
+        self.window = RollingWindow(window)
+        self.threshold = float(threshold)
+
+    def check(self, generation, grade, best_fitness):
+        """See Plateau.check."""
+        self.window.push(grade)
+        if self.window.full and self.window.variance < self.threshold:
+            return "Variance of the grades fell below {}".format(self.threshold)
+        return None
+
+
+class Stagnation():
+    """Stops when the best fitness didn't improve for a number of generations."""
+
+    def __init__(self, generations, tolerance=0):
+        """
+        generations: the number of generations without improvement
+        tolerance: improvements up to this amount don't count
+        """
+        self.generations = int(generations)
+        self.tolerance = float(tolerance)
+        self.best = None
+        self.since = 0
+
+    def check(self, generation, grade, best_fitness):
+        """See Plateau.check."""
+        if best_fitness is None:
+            return None
+        if self.best is None or best_fitness < self.best - self.tolerance:
+            self.best = best_fitness
+            self.since = 0
+        else:
+            self.since += 1
+        if self.since >= self.generations:
+            return "Best fitness didn't improve for {} generations".format(self.generations)
+        return None
+
+    def getstate(self):
+        """Returns the best fitness so far and the generations since it as a dict."""
+        return {"best": self.best, "since": self.since}
+
+    def setstate(self, state):
+        """
+        Restores a state returned by getstate.
+
+        state: the state to restore
+        """
+        self.best = state["best"]
+        self.since = state["since"]
+
+
+class TimeBudget():
+    """Stops when the run took longer than a number of seconds."""
+
+    def __init__(self, seconds):
+        """
+        seconds: the wall clock time the evolution may take
+        """
+        self.seconds = float(seconds)
+        self.start = time.monotonic()
+
+    def check(self, generation, grade, best_fitness):
+        """See Plateau.check."""
+        if time.monotonic() - self.start >= self.seconds:
+            return "Time budget of {:g}s used up".format(self.seconds)
+        return None
+
+
+class TargetFitness():
+    """Stops as soon as a track is at least as fit as the target."""
+
+    def __init__(self, fitness):
+        """
+        fitness: the fitness to reach, lower is better
+        """
+        self.fitness = float(fitness)
+
+    def check(self, generation, grade, best_fitness):
+        """See Plateau.check."""
+        if best_fitness is not None and best_fitness <= self.fitness:
+            return "Target fitness {:g} reached".format(self.fitness)
+        return None
+
+
+class ConvergenceDetector():
+    """Decides when to stop the evolution using a list of stop criteria."""
+
+    def __init__(self, criteria):
+        """
+        criteria: objects with a check method like Plateau.check,
+                  the first one giving a reason stops the evolution
+        """
+        self.criteria = list(criteria)
+        self.reason = None
+
+    def update(self, generation, grade, best_fitness=None):
+        """
+        Adds the results of a generation and returns whether to stop.
+
+        Every criterion sees every generation, so windows stay complete
+        even after another criterion fired.
+
+        generation: the number of the generation
+        grade: the grade of the generation
+        best_fitness: the best fitness of the generation, None if unknown
+        """
+        reasons = [criterion.check(generation, grade, best_fitness)
+                   for criterion in self.criteria]
+        for reason in reasons:
+            if reason is not None:
+                self.reason = reason
+                return True
+        return False
+
+    def getstate(self):
+        """
+        Returns the state of the criteria which can't be rebuilt from the
+        grades by prime, e.g. to be saved in a checkpoint.
+
+        The state is a list of [name, state] pairs with the class name of
+        every criterion having a getstate method.
+        """
+        return [[type(criterion).__name__, criterion.getstate()]
+                for criterion in self.criteria if hasattr(criterion, "getstate")]
+
+    def setstate(self, state):
+        """
+        Restores a state returned by getstate. States of criteria which
+        aren't used anymore are ignored.
+
+        state: the state to restore
+        """
+        criteria = [criterion for criterion in self.criteria
+                    if hasattr(criterion, "getstate")]
+        for criterion, (name, criterion_state) in zip(criteria, state):
+            if type(criterion).__name__ == name:
+                criterion.setstate(criterion_state)
+
+    def prime(self, grades):
+        """
+        Feeds the grades of earlier generations, e.g. of a checkpoint,
+        to the criteria without stopping. Criteria which need more than
+        the grades are restored by setstate.
+
+        grades: (generation, grade) tuples
+        """
+        for generation, grade in grades:
+            self.update(generation, grade)
+        self.reason = None
+
+
+class GradeHistory():
+    """
+    The grades of a run stored as a compact float array.
+
+    The grades of consecutive generations are collected in chunks, full
+    chunks are appended to a binary file of float64 values if one is
+    given, so very long runs don't keep their whole history in memory
+    and the grades so far can be read while the run goes on.
+    """
+
+    def __init__(self, chunk_size=10000, filename="", first_generation=1, keep=0):
+        """
+        Creates the history, empty unless grades of the file are kept.
+
+        chunk_size: the number of grades kept in memory
+        filename: file to which full chunks are spilled, kept in memory if empty
+        first_generation: the generation of the first grade
+        keep: the number of grades already in the file which are continued,
+              e.g. up to the generation of a checkpoint, the file is cut
+              after them
+        """
+        self.chunk_size = max(1, int(chunk_size))
+        self.filename = filename
+        self.first_generation = first_generation
+        self.spilled = 0
+        self.chunks = []
+        self.chunk = np.zeros(self.chunk_size)
+        self.filled = 0
+        if keep:
+            if not filename or not os.path.exists(filename) or \
+                    os.path.getsize(filename) < keep * 8:
+                raise Exception("Grade history " + filename + " is incomplete.")
+            with open(filename, "r+b") as history_file:
+                history_file.truncate(keep * 8)
+            self.spilled = keep
+        elif filename and os.path.exists(filename):
+            os.remove(filename)
+
+    def __len__(self):
+        return self.spilled + len(self.chunks) * self.chunk_size + self.filled
+
+    def __iter__(self):
+        """Yields (generation, grade) tuples."""
+        generation = self.first_generation
+        for chunk in self._chunks():
+            for grade in chunk.tolist():
+                yield (generation, grade)
+                generation += 1
+
+    def _chunks(self):
+        """Yields the grades chunk by chunk, starting with the spilled ones."""
+        if self.spilled:
+            spilled = np.memmap(self.filename, dtype=np.float64, mode="r",
+                                shape=(self.spilled,))
+            for start in range(0, self.spilled, self.chunk_size):
+                yield np.array(spilled[start:start + self.chunk_size])
+            del spilled
+        for chunk in self.chunks:
+            yield chunk
+        yield self.chunk[:self.filled]
+
+    def append(self, grade):
+        """
+        Adds the grade of the next generation.
+
+        grade: the grade
+        """
+        self.chunk[self.filled] = grade
+        self.filled += 1
+        if self.filled == self.chunk_size:
+            if self.filename:
+                self.flush()
+            else:
+                self.chunks.append(self.chunk)
+                self.chunk = np.zeros(self.chunk_size)
+                self.filled = 0
+
+    def flush(self):
+        """Appends the grades kept in memory to the file, if there is one."""
+        if not self.filename or not self.filled:
+            return
+        directory = os.path.dirname(self.filename)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        with open(self.filename, "ab") as history_file:
+            history_file.write(self.chunk[:self.filled].tobytes())
+        self.spilled += self.filled
+        self.filled = 0
+
+    def as_array(self):
+        """Returns the history as an (n, 2) array of generations and grades."""
+        grades = np.concatenate(list(self._chunks()))
+        generations = np.arange(self.first_generation,
+                                self.first_generation + len(grades))
+        return np.stack((generations, grades), axis=1)
@@ -0,0 +1,21 @@
+#!/usr/bin/env python3
+
+import argparse
+from map import Map
+
+
+def main():
+    """Converts text maps into the binary map format."""
+    parser = argparse.ArgumentParser(description="Converts a map into the binary map format,"
+                                                 " which loads without parsing.")
+    parser.add_argument("input", help="file name of the text or binary map")
+    parser.add_argument("output", help="file name of the binary map")
+    args = parser.parse_args()
+
+    # the acceleration isn't part of the map file
+    map = Map(1, args.input)
+    map.save_binary(args.output)
+    print("Converted {} walls from {} to {}.".format(len(map.map), args.input, args.output))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+import heapq
+import os
+from math import ceil, sqrt
+import numpy as np
+from intersect import intersect_matrix
+
+# increase whenever the computation changes, so old cache files are ignored
+DISTANCE_FIELD_VERSION = 1
+
+# the eight neighbours of a node with the length of the step to them
+STEPS = [(1, 0, 1.0), (-1, 0, 1.0), (0, 1, 1.0), (0, -1, 1.0),
+         (1, 1, sqrt(2)), (-1, -1, sqrt(2)), (1, -1, sqrt(2)), (-1, 1, sqrt(2))]
+
+
+class DistanceField():
+    """
+    The length of the shortest way around the walls to the target
+    for the nodes of a grid over the map.
+
+    The nodes are connected to their eight neighbours unless the step
+    between them touches a wall, following the rules of do_intersect.
+    Distances of other points are approximated by their nearest node.
+    """
+
+    def __init__(self, map, cell_size=0, distances=None, origin=(0, 0)):
+        """
+        Computes the field.
+
+        map: the map with the walls and the target
+        cell_size: the distance between neighbouring nodes, chosen from
+                   the size of the map if not given
+        distances: previously computed distances, skips the computation
+        origin: the position of the first node if distances are given
+        """
+        self.target = map.target
+        if distances is not None:
+            self.cell_size = int(cell_size)
+            self.min_x, self.min_y = (int(coordinate) for coordinate in origin)
+            self.distances = distances
+            return
+        self.min_x, self.min_y, max_x, max_y = map.bounds
+        extent = max(max_x - self.min_x, max_y - self.min_y)
+        if not cell_size:
+            # at most about 500 x 500 nodes
+            cell_size = ceil(extent / 500)
+        self.cell_size = max(1, int(cell_size))
+        size = extent // self.cell_size + 2
+        self.distances = self._compute(map, size, size)
+
+    def __repr__(self):
+        return "Cell size: {} Nodes: {}".format(self.cell_size, self.distances.shape)
+
+    def _blocked(self, map, size_x, size_y):
+        """
+        Returns for every step in STEPS a flat list which is true for the
+        nodes from which the step hits a wall.
+        """
+        blocked = [np.zeros((size_x, size_y), dtype=bool) for _ in STEPS]
+        for wall in map.walls.tolist():
+            x1, y1, x2, y2 = wall
+            # only the nodes around the wall can be affected
+            low_x = max((min(x1, x2) - self.min_x) // self.cell_size - 1, 0)
+            high_x = min((max(x1, x2) - self.min_x) // self.cell_size + 2, size_x - 1)
+            low_y = max((min(y1, y2) - self.min_y) // self.cell_size - 1, 0)
+            high_y = min((max(y1, y2) - self.min_y) // self.cell_size + 2, size_y - 1)
+            if low_x > high_x or low_y > high_y:
+                continue
+            nodes_x, nodes_y = np.mgrid[low_x:high_x + 1, low_y:high_y + 1]
+            from_x = nodes_x.ravel() * self.cell_size + self.min_x
+            from_y = nodes_y.ravel() * self.cell_size + self.min_y
+            for (dx, dy, _), mask in zip(STEPS, blocked):
+                segments = np.stack((from_x, from_y,
+                                     from_x + dx * self.cell_size,
+                                     from_y + dy * self.cell_size), axis=1)
+                hits = intersect_matrix(segments, [wall])[:, 0]
+                mask[nodes_x.ravel()[hits], nodes_y.ravel()[hits]] = True
+        return [mask.ravel().tolist() for mask in blocked]
+
+    def _compute(self, map, size_x, size_y):
+        """Runs Dijkstra's algorithm from the node nearest to the target."""
+        blocked = self._blocked(map, size_x, size_y)
+        distances = [float("inf")] * (size_x * size_y)
+        target_x, target_y = self._node(self.target.x, self.target.y, size_x, size_y)
+        target = target_x * size_y + target_y
+        distances[target] = 0.0
+        queue = [(0.0, target)]
+        while queue:
+            distance, node = heapq.heappop(queue)
+            if distance > distances[node]:
+                continue
+            x, y = divmod(node, size_y)
+            for (dx, dy, length), step_blocked in zip(STEPS, blocked):
+                if step_blocked[node]:
+                    continue
+                neighbour_x = x + dx
+                neighbour_y = y + dy
+                if not (0 <= neighbour_x < size_x and 0 <= neighbour_y < size_y):
+                    continue
+                neighbour = neighbour_x * size_y + neighbour_y
+                new_distance = distance + length * self.cell_size
+                if new_distance < distances[neighbour]:
+                    distances[neighbour] = new_distance
+                    heapq.heappush(queue, (new_distance, neighbour))
+        distances = np.array(distances).reshape(size_x, size_y)
+        # nodes cut off by walls get the longest way plus the straight line
+        unreachable = np.isinf(distances)
+        if unreachable.any():
+            nodes_x, nodes_y = np.nonzero(unreachable)
+            straight = np.hypot(nodes_x * self.cell_size + self.min_x - self.target.x,
+                                nodes_y * self.cell_size + self.min_y - self.target.y)
+            distances[unreachable] = distances[~unreachable].max() + straight
+        return distances
+
+    def _node(self, x, y, size_x, size_y):
+        """Returns the indices of the node nearest to a point inside the grid."""
+        node_x = min(max(int(round((x - self.min_x)/self.cell_size)), 0), size_x - 1)
+        node_y = min(max(int(round((y - self.min_y)/self.cell_size)), 0), size_y - 1)
+        return node_x, node_y
+
+    def distance(self, point):
+        """
+        Returns the distance from a point to the target.
+
+        point: the point
+        """
+        size_x, size_y = self.distances.shape
+        node_x, node_y = self._node(point.x, point.y, size_x, size_y)
+        offset_x = point.x - (node_x * self.cell_size + self.min_x)
+        offset_y = point.y - (node_y * self.cell_size + self.min_y)
+        return (float(self.distances[node_x, node_y]) +
+                sqrt(offset_x * offset_x + offset_y * offset_y))
+
+    def lookup(self, positions):
+        """
+        Vectorized version of distance.
+
+        positions: (n, 2) array of points
+        """
+        positions = np.asarray(positions).reshape(-1, 2)
+        size_x, size_y = self.distances.shape
+        node_x = np.clip(np.rint((positions[:, 0] - self.min_x)/self.cell_size),
+                         0, size_x - 1).astype(np.intp)
+        node_y = np.clip(np.rint((positions[:, 1] - self.min_y)/self.cell_size),
+                         0, size_y - 1).astype(np.intp)
+        return (self.distances[node_x, node_y] +
+                np.hypot(positions[:, 0] - (node_x * self.cell_size + self.min_x),
+                         positions[:, 1] - (node_y * self.cell_size + self.min_y)))
+
+
+def load_distance_field(map, cell_size=0, cache_directory=""):
+    """
+    Returns the distance field of a map, computing it only if it isn't
+    cached yet.
+
+    The cache files are named after the checksum of the map file,
+    so changed maps are never served an old field.
+
+    map: the map, loaded from a file to be cached
+    cell_size: the distance between neighbouring nodes, 0 chooses it
+    cache_directory: folder of the cache files, no caching if empty
+    """
+    filename = None
+    if cache_directory and map.checksum:
+        filename = os.path.join(cache_directory, "distance_{}_{}_{}.npz".format(
+            map.checksum, int(cell_size), DISTANCE_FIELD_VERSION))
+        if os.path.isfile(filename):
+            with np.load(filename) as cached:
+                return DistanceField(map, int(cached["cell_size"]),
+                                     distances=cached["distances"],
+                                     origin=cached["origin"])
+    field = DistanceField(map, cell_size)
+    if filename:
+        if not os.path.exists(cache_directory):
+            os.makedirs(cache_directory)
+        temporary = filename + ".tmp"
+        with open(temporary, "wb") as cache_file:
+            np.savez(cache_file, distances=field.distances,
+                     cell_size=np.int64(field.cell_size),
+                     origin=np.array([field.min_x, field.min_y], dtype=np.int64))
+        os.replace(temporary, filename)
+    return field
@@ -1,56 +1,158 @@
-import svgwrite
-from svgwrite.shapes import Line
-from random import randint
+from random import Random
+from math import ceil
+import gzip
 import os
 
+SVG_HEADER = ('<?xml version="1.0" encoding="utf-8" ?>\n'
+              '<svg baseProfile="full" height="100%" version="1.1" width="100%" '
+              'xmlns="http://www.w3.org/2000/svg" '
+              'xmlns:ev="http://www.w3.org/2001/xml-events" '
+              'xmlns:xlink="http://www.w3.org/1999/xlink"><defs />')
+
+def _open_svg(filename, out_directory):
+    """Opens a SVG file for writing, gzip compressed if it ends with .svgz."""
+    # create out directory if it doesn't exist
+    if not os.path.exists(out_directory):
+        os.makedirs(out_directory)
+    path = out_directory + "/" + filename
+    if filename.endswith(".svgz"):
+        return gzip.open(path, "wt", encoding="utf-8")
+    else:
+        return open(path, "w", encoding="utf-8", buffering=1 << 16)
+
 def save_svg(filename, map, tracks=[], grade="", border=5, out_directory="out"):
     """
     Saves a graphical representation of the map to a SVG file.
 
+    The SVG is streamed straight into the file, every track
+    becomes a single polyline. Files ending with .svgz are gzip compressed.
+
     filename: the name of the SVG file
     map: map object which should be saved
     tracks: optional track objects which should also be saved
     border: how big the border should be
     out_directory: folder in which to save the SVG file
     """
-    # create out directory if it doesn't exist
-    if not os.path.exists(out_directory):
-        os.makedirs(out_directory)
-    svg = svgwrite.Drawing(out_directory + "/" + filename)
-    # background
-    svg.add(svg.rect((0,0), (map.size_x+2*border, map.size_y+2*border), fill="white"))
-    # paint walls
-    walls = svg.add(svg.g(id="walls", stroke="red"))
-    for line in map.map:
-        p = (line[0].x + border, line[0].y + border)
-        q = (line[1].x + border, line[1].y + border)
-        walls.add(svg.line(p, q))
-    # paint start
-    start_x, start_y = map.start
-    svg.add(svg.circle((start_x + border, start_y + border), 2, fill="green"))
-    # paint target
-    target_x, target_y = map.target
-    svg.add(svg.circle((target_x + border, target_y + border), 2, fill="blue"))
-    # paint tracks
-    for i, track in enumerate(tracks):
-        id = "track_{:010d}".format(i)
-        color = "rgb({:3d},{:3d},{:3d})".format(randint(0, 255),
-                                                randint(0, 255),
-                                                randint(0, 255))
-        svg_track = svg.add(svg.g(id=id, stroke=color))
-        for i in range(1, len(track.positions)):
+    with _open_svg(filename, out_directory) as svg:
+        svg.write(SVG_HEADER)
+        # background
+        svg.write('<rect fill="white" height="{}" width="{}" x="0" y="0" />'.format(
+            map.size_y + 2*border, map.size_x + 2*border))
+        # paint walls
+        svg.write('<g id="walls" stroke="red">')
+        for line in map.map:
+            svg.write('<line x1="{}" x2="{}" y1="{}" y2="{}" />'.format(
+                line[0].x + border, line[1].x + border,
+                line[0].y + border, line[1].y + border))
+        svg.write('</g>')
+        # paint start
+        start_x, start_y = map.start
+        svg.write('<circle cx="{}" cy="{}" fill="green" r="2" />'.format(
+            start_x + border, start_y + border))
+        # paint target
+        target_x, target_y = map.target
+        svg.write('<circle cx="{}" cy="{}" fill="blue" r="2" />'.format(
+            target_x + border, target_y + border))
+        # paint tracks
+        max_x = map.size_x + 2 * border
+        max_y = map.size_y + 2 * border
+        # colors from a fixed seed keep the plots reproducible and
+        # don't draw from the random streams of the evolution
+        colors = Random(0)
+        for i, track in enumerate(tracks):
+            id = "track_{:010d}".format(i)
+            color = "rgb({:3d},{:3d},{:3d})".format(colors.randint(0, 255),
+                                                    colors.randint(0, 255),
+                                                    colors.randint(0, 255))
             # ensure that the tracks end at the border
-            p_x = min(map.size_x + 2 * border, track.positions[i-1].x + border)
-            p_x = max(p_x, 0)
-            p_y = min(map.size_y + 2 * border, track.positions[i-1].y + border)
-            p_y = max(p_y, 0)
-            q_x = min(map.size_x + 2 * border, track.positions[i].x + border)
-            q_x = max(q_x, 0)
-            q_y = min(map.size_y + 2 * border, track.positions[i].y + border)
-            q_y = max(q_y, 0)
-            svg_track.add(svg.line((p_x, p_y), (q_x, q_y)))
-    # print grade if supplied
-    if grade:
-        string = "Grade: {:3.2f}".format(grade)
-        svg.add(svg.text(string, insert=(0.5*map.size_x + border, 0.1*map.size_y + border), fill="black", style="font-size:8"))
-    svg.save()
+            points = " ".join("{},{}".format(max(min(max_x, x + border), 0),
+                                             max(min(max_y, y + border), 0))
+                              for x, y in track.positions)
+            svg.write('<g fill="none" id="{}" stroke="{}"><polyline points="{}" /></g>'.format(
+                id, color, points))
+        # print grade if supplied
+        if grade:
+            string = "Grade: {:3.2f}".format(grade)
+            svg.write('<text fill="black" style="font-size:8" x="{}" y="{}">{}</text>'.format(
+                0.5*map.size_x + border, 0.1*map.size_y + border, string))
+        svg.write('</svg>')
+
+def save_grades_svg(filename, grades, width=800, height=400, max_points=2000,
+                    out_directory="out"):
+    """
+    Saves a line chart of the grades to a SVG file.
+
+    The grades are read twice, once for the scale and once for the line,
+    and long histories are reduced to the lowest and highest grade of
+    each of max_points/2 buckets, so the chart never needs the whole
+    history in memory.
+
+    filename: the name of the SVG file
+    grades: (timestep, grade) tuples which can be iterated twice
+            and have a length, e.g. a GradeHistory
+    width: width of the chart in pixels
+    height: height of the chart in pixels
+    max_points: the maximum number of points of the line
+    out_directory: folder in which to save the SVG file
+    """
+    count = len(grades)
+    first = last = None
+    low = high = 0
+    for timestep, grade in grades:
+        if first is None:
+            first = timestep
+            low = high = grade
+        last = timestep
+        low = min(low, grade)
+        high = max(high, grade)
+    margin = 50
+    plot_width = width - 2 * margin
+    plot_height = height - 2 * margin
+
+    def point(timestep, grade):
+        x = margin + plot_width * (timestep - first) / max(last - first, 1)
+        y = margin + plot_height * (high - grade) / (high - low if high > low else 1)
+        return "{:.1f},{:.1f}".format(x, y)
+
+    with _open_svg(filename, out_directory) as svg:
+        svg.write(SVG_HEADER)
+        svg.write('<rect fill="white" height="{}" width="{}" x="0" y="0" />'.format(
+            height, width))
+        # axes with the ranges of the data
+        svg.write('<g stroke="black"><line x1="{0}" x2="{0}" y1="{1}" y2="{2}" />'
+                  '<line x1="{0}" x2="{3}" y1="{2}" y2="{2}" /></g>'.format(
+                      margin, margin, height - margin, width - margin))
+        svg.write('<g fill="black" style="font-size:10">')
+        if count:
+            for text, x, y, anchor in (
+                    ("{:.2f}".format(high), margin - 4, margin + 4, "end"),
+                    ("{:.2f}".format(low), margin - 4, height - margin, "end"),
+                    (str(first), margin, height - margin + 14, "middle"),
+                    (str(last), width - margin, height - margin + 14, "middle")):
+                svg.write('<text text-anchor="{}" x="{}" y="{}">{}</text>'.format(
+                    anchor, x, y, text))
+        svg.write('<text text-anchor="middle" x="{}" y="{}">Timestep</text>'.format(
+            width / 2, height - margin / 3))
+        svg.write('<text text-anchor="middle" transform="rotate(-90)" x="{}" y="{}">'
+                  'Grade</text></g>'.format(-height / 2, margin / 3))
+        # the line, one bucket at a time
+        svg.write('<polyline fill="none" id="grades" stroke="blue" points="')
+        bucket_size = max(1, ceil(count / max(max_points // 2, 1)))
+        bucket = []
+        for timestep, grade in grades:
+            bucket.append((timestep, grade))
+            if len(bucket) == bucket_size:
+                svg.write(_bucket_points(bucket, point))
+                bucket = []
+        if bucket:
+            svg.write(_bucket_points(bucket, point))
+        svg.write('" /></svg>')
+
+def _bucket_points(bucket, point):
+    """Returns the lowest and highest grade of a bucket as polyline points in order."""
+    if len(bucket) == 1:
+        return point(*bucket[0]) + " "
+    lowest = min(bucket, key=lambda x: x[1])
+    highest = max(bucket, key=lambda x: x[1])
+    ordered = sorted(set((lowest, highest)))
+    return "".join(point(*x) + " " for x in ordered)
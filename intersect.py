@@ -2,9 +2,14 @@
 from collections import namedtuple
 import timeit
 from random import randint
+import numpy as np
 
 Point = namedtuple("Point", ["x", "y"])
 
+# below this number of segment/wall pairs the per call overhead of numpy
+# outweighs the vectorization, so the pairs are tested one by one
+BATCH_MIN_PAIRS = 64
+
 def on_segment(p, q, r):
     """
     Given three colinear points p, q, r,
@@ -109,6 +114,116 @@ def do_intersect(p, q, verbose=False):
         return False
 
 
+def as_segment_array(segments):
+    """
+    Converts segments into an integer array of shape (n, 4).
+
+    segments: either an array like of (x1, y1, x2, y2) rows
+              or a sequence of (p, q) point tuples
+    """
+    array = np.asarray(segments, dtype=np.int64)
+    return array.reshape(-1, 4)
+
+def _orientations(px, py, qx, qy, rx, ry):
+    """
+    Vectorized version of orientation.
+
+    Returns the sign of the orientation value instead of 0, 1, 2:
+    0 --> colinear
+    1 --> clockwise
+    -1 --> counterclockwise
+    """
+    return np.sign((qy - py) * (rx - qx) - (qx - px) * (ry - qy))
+
+def _on_segments(px, py, qx, qy, rx, ry):
+    """Vectorized version of on_segment."""
+    return ((qx <= np.maximum(px, rx)) & (qx >= np.minimum(px, rx)) &
+            (qy <= np.maximum(py, ry)) & (qy >= np.minimum(py, ry)))
+
+def _intersect(p1x, p1y, p2x, p2y, q1x, q1y, q2x, q2y):
+    """
+    Vectorized version of _do_intersect for the coordinate arrays
+    of segments p and walls q, which are broadcast against each other.
+    """
+    o1 = _orientations(p1x, p1y, p2x, p2y, q1x, q1y)
+    o2 = _orientations(p1x, p1y, p2x, p2y, q2x, q2y)
+    o3 = _orientations(q1x, q1y, q2x, q2y, p1x, p1y)
+    o4 = _orientations(q1x, q1y, q2x, q2y, p2x, p2y)
+
+    # General case
+    result = (o1 != o2) & (o3 != o4)
+    # Special Cases
+    result |= (o1 == 0) & _on_segments(p1x, p1y, q1x, q1y, p2x, p2y)
+    result |= (o2 == 0) & _on_segments(p1x, p1y, q2x, q2y, p2x, p2y)
+    result |= (o3 == 0) & _on_segments(q1x, q1y, p1x, p1y, q2x, q2y)
+    result |= (o4 == 0) & _on_segments(q1x, q1y, p2x, p2y, q2x, q2y)
+    return result
+
+def intersect_matrix(segments, walls):
+    """
+    Tests every segment against every wall in one vectorized pass.
+
+    Uses exactly the same rules as _do_intersect, including the colinear
+    and endpoint special cases.
+
+    segments: segments as accepted by as_segment_array
+    walls: walls as accepted by as_segment_array
+
+    Returns a boolean array of shape (len(segments), len(walls)).
+    """
+    segments = as_segment_array(segments)
+    walls = as_segment_array(walls)
+    # segments along the first axis, walls along the second
+    return _intersect(segments[:, 0, None], segments[:, 1, None],
+                      segments[:, 2, None], segments[:, 3, None],
+                      walls[None, :, 0], walls[None, :, 1],
+                      walls[None, :, 2], walls[None, :, 3])
+
+def intersect_pairs(segments, walls):
+    """
+    Tests the i-th segment against the i-th wall for all i.
+
+    Uses the same rules as intersect_matrix.
+
+    segments: segments as accepted by as_segment_array
+    walls: walls as accepted by as_segment_array, as many as segments
+
+    Returns a boolean array of shape (len(segments),).
+    """
+    segments = as_segment_array(segments)
+    walls = as_segment_array(walls)
+    return _intersect(segments[:, 0], segments[:, 1], segments[:, 2], segments[:, 3],
+                      walls[:, 0], walls[:, 1], walls[:, 2], walls[:, 3])
+
+def batch_intersect(segments, walls):
+    """
+    Returns a boolean mask which is true for every segment
+    which intersects at least one wall.
+
+    segments: segments as accepted by as_segment_array
+    walls: walls as accepted by as_segment_array
+    """
+    segments = as_segment_array(segments)
+    walls = as_segment_array(walls)
+    if len(segments) == 0 or len(walls) == 0:
+        return np.zeros(len(segments), dtype=bool)
+    return intersect_matrix(segments, walls).any(axis=1)
+
+def first_intersection(segments, walls):
+    """
+    Returns the index of the first segment which intersects a wall
+    or -1 if no segment intersects.
+
+    segments: segments as accepted by as_segment_array
+    walls: walls as accepted by as_segment_array
+    """
+    mask = batch_intersect(segments, walls)
+    hits = np.flatnonzero(mask)
+    if len(hits) == 0:
+        return -1
+    return int(hits[0])
+
+
 def setup_benchmark():
     """Generates random points for benchmark purposes."""
     global benchmark_points
@@ -128,12 +243,21 @@ def benchmark():
     for lines in benchmark_points:
         do_intersect((lines[0], lines[1]), (lines[2], lines[3]))
 
+def benchmark_batch():
+    # 100 segments against 100 walls, the same number of tests as benchmark()
+    segments = as_segment_array([(lines[0], lines[1]) for lines in benchmark_points[:100]])
+    walls = as_segment_array([(lines[2], lines[3]) for lines in benchmark_points[:100]])
+    intersect_matrix(segments, walls)
+
 def main():
     """Benchmark"""
     setup_benchmark()
     results = (timeit.Timer("benchmark()", setup="from __main__ import benchmark").repeat(10, 1))
     print(results)
     print("Minimum: " + str(min(results)))
+    results = (timeit.Timer("benchmark_batch()", setup="from __main__ import benchmark_batch").repeat(10, 1))
+    print(results)
+    print("Minimum (batch): " + str(min(results)))
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,186 @@
+import multiprocessing
+from track import export_track, import_track
+from rng import RandomStream
+from stats import stats
+
+
+def _graded(population):
+    """Returns the tracks of a population with their fitness, best first."""
+    graded = [(population.fitness(track), track) for track in population.tracks]
+    graded.sort(key=lambda x: x[0])
+    return graded
+
+
+def _island(connection, population_class, kwargs, profile=False):
+    """
+    Main loop of an island worker process.
+
+    connection: pipe to the controlling IslandPopulation
+    population_class: the population backend to use
+    kwargs: arguments for the population, including its own RandomStream
+    profile: if set the island collects stats
+    """
+    stats.enabled = profile
+    population = population_class(**kwargs)
+    while True:
+        command, argument = connection.recv()
+        if command == "evolve":
+            grade = population.evolve()
+            connection.send((grade, population.best_fitness, population.diversity))
+        elif command == "emigrate":
+            connection.send([export_track(track) for _, track
+                             in _graded(population)[:argument]])
+        elif command == "immigrate":
+            # immigrants replace the worst individuals
+            tracks = [track for _, track in _graded(population)]
+            immigrants = [import_track(population.map, state) for state in argument]
+            if immigrants:
+                tracks[-len(immigrants):] = immigrants
+            population.tracks = tracks
+            connection.send(True)
+        elif command == "rates":
+            population.set_rates(**argument)
+            connection.send(True)
+        elif command == "replace":
+            population.tracks = [import_track(population.map, state) for state in argument]
+            connection.send(True)
+        elif command == "stats":
+            connection.send(stats.as_dict())
+            stats.reset()
+        elif command == "tracks":
+            connection.send([(fitness, export_track(track)) for fitness, track
+                             in _graded(population)])
+        elif command == "stop":
+            connection.send(True)
+            break
+        else:
+            raise Exception("Unsupported island command: " + command)
+    connection.close()
+
+
+class IslandPopulation():
+    """
+    A population split into islands which evolve in parallel worker processes.
+
+    Every migration_interval generations the best tracks of each island
+    migrate to the next island, replacing its worst tracks. The generation
+    attribute counts the finished generations, a resumed run sets it to
+    the generation of its checkpoint to keep the migrations in step.
+    """
+
+    def __init__(self, islands, migration_interval, migration_size,
+                 population_class, map, population_size, rng=None, **kwargs):
+        """
+        Starts the island workers.
+
+        islands: the number of islands (i.e. worker processes)
+        migration_interval: generations between migrations, 0 disables migration
+        migration_size: the number of tracks migrating from each island
+        population_class: the population backend used on the islands
+        map: the map on which the tracks should take place
+        population_size: the total number of individuals of all islands
+        rng: the RandomStream of the run, every island gets a stream
+             spawned from it, so the islands evolve the same way no matter
+             how their processes are scheduled
+        kwargs: further arguments for population_class
+        """
+        self.map = map
+        self.migration_interval = int(migration_interval)
+        self.migration_size = int(migration_size)
+        self.generation = 0
+        self.best_fitness = None
+        self.diversity = None
+        self.rng = rng if rng is not None else RandomStream()
+        islands = int(islands)
+        population_size = int(population_size)
+        self.sizes = [population_size // islands +
+                      (1 if i < population_size % islands else 0)
+                      for i in range(islands)]
+        self.connections = []
+        self.workers = []
+        for size, island_rng in zip(self.sizes, self.rng.spawn(islands)):
+            connection, worker_connection = multiprocessing.Pipe()
+            # the islands already run in parallel and being daemonic
+            # processes they couldn't start an initialization pool anyway,
+            # progress messages of the islands would garble the terminal
+            arguments = dict(kwargs, map=map, population_size=size, init_workers=1,
+                             progress=None, rng=island_rng)
+            worker = multiprocessing.Process(
+                target=_island,
+                args=(worker_connection, population_class, arguments, stats.enabled),
+                daemon=True)
+            worker.start()
+            self.connections.append(connection)
+            self.workers.append(worker)
+
+    def _broadcast(self, command, arguments=None):
+        """
+        Sends a command to every island and returns their answers.
+
+        command: the command
+        arguments: optional list with an argument for each island
+        """
+        if arguments is None:
+            arguments = [None] * len(self.connections)
+        for connection, argument in zip(self.connections, arguments):
+            connection.send((command, argument))
+        return [connection.recv() for connection in self.connections]
+
+    @property
+    def tracks(self):
+        """The tracks of all islands, best first."""
+        graded = [graded_track for island in self._broadcast("tracks")
+                  for graded_track in island]
+        graded.sort(key=lambda x: x[0])
+        return [import_track(self.map, state) for _, state in graded]
+
+    @tracks.setter
+    def tracks(self, tracks):
+        """Distributes the tracks round robin over the islands."""
+        chunks = [tracks[i::len(self.connections)] for i in range(len(self.connections))]
+        self._broadcast("replace", [[export_track(track) for track in chunk]
+                                    for chunk in chunks])
+        self.sizes = [len(chunk) for chunk in chunks]
+
+    def set_rates(self, **rates):
+        """
+        Changes the rates of the evolution on every island.
+
+        rates: the arguments of Population.set_rates
+        """
+        self._broadcast("rates", [rates] * len(self.connections))
+
+    def migrate(self):
+        """Moves the best tracks of every island to the next island."""
+        emigrants = self._broadcast("emigrate", [self.migration_size] * len(self.connections))
+        # ring topology
+        immigrants = emigrants[-1:] + emigrants[:-1]
+        self._broadcast("immigrate", immigrants)
+
+    def evolve(self):
+        """Evolves every island by one generation and returns the overall grade."""
+        results = self._broadcast("evolve")
+        grades = [grade for grade, _, _ in results]
+        best = [best_fitness for _, best_fitness, _ in results if best_fitness is not None]
+        self.best_fitness = min(best) if best else None
+        self.diversity = sum(diversity * size for (_, _, diversity), size
+                             in zip(results, self.sizes)) / max(sum(self.sizes), 1)
+        self.generation += 1
+        if (len(self.connections) > 1 and self.migration_interval and
+                self.generation % self.migration_interval == 0):
+            with stats.phase("migration"):
+                self.migrate()
+        if stats.enabled:
+            for island_stats in self._broadcast("stats"):
+                stats.merge(island_stats)
+        return sum(grade * size for grade, size
+                   in zip(grades, self.sizes)) / sum(self.sizes)
+
+    def close(self):
+        """Stops the island workers."""
+        if self.workers:
+            self._broadcast("stop")
+            for worker in self.workers:
+                worker.join()
+            self.connections = []
+            self.workers = []
@@ -3,10 +3,23 @@
 import argparse
 import configparser
 import os
+import shutil
 import sys
+import time
 from map import Map
 from population import Population
-from graphics import save_svg
+from array_population import ArrayPopulation
+from islands import IslandPopulation
+from graphics import save_svg, save_grades_svg
+from writer import BackgroundWriter
+from stats import stats
+from checkpoint import save_checkpoint, load_checkpoint
+from solver import Solver
+from rng import RandomStream
+from adaptive import RateController, truncate_log
+from convergence import (ConvergenceDetector, GradeHistory, Plateau, Stagnation,
+                         TargetFitness, TimeBudget, VarianceThreshold)
+from track import export_track, import_track
 from contexttimer import Timer
 from collections import deque
 from ast import literal_eval
@@ -21,26 +34,165 @@ class CircularBuffer(deque):
         else:
             return 0
 
+def parse_arguments(argv=None):
+    """Parses the command line arguments."""
+    parser = argparse.ArgumentParser(description="Simulates evolution"
+                                                    " for tracks on a given map.")
+    parser.add_argument("--config_file", help="file name of the config file",
+                        default="default.cfg")
+    parser.add_argument("--resume", action="store_true",
+                        help="continue the run from its last checkpoint")
+    parser.add_argument("--headless", action="store_true",
+                        help="report progress as plain lines without terminal control")
+    parser.add_argument("--updates_per_second", type=float, default=10,
+                        help="maximum rate of progress messages, 0 for no limit")
+    return parser.parse_args(argv)
+
+def population_class(config):
+    """
+    Returns the population class selected by the config.
+
+    config: the parsed config file
+    """
+    population_backend = config["Map"].get("population_backend", "tracks")
+    if population_backend == "arrays":
+        return ArrayPopulation
+    elif population_backend == "tracks":
+        return Population
+    else:
+        raise Exception("Unsupported population backend: " + population_backend)
+
+def population_arguments(config, map, progress=None):
+    """
+    Returns the keyword arguments of the population from the config.
+
+    The random stream of the population is seeded with the seed of the
+    config, or freshly if it is empty.
+
+    config: the parsed config file
+    map: the map the population evolves on
+    progress: optional callback receiving the progress of the initialisation
+    """
+    seed = config.get("Map", "seed", fallback="").strip()
+    return dict(
+            map=map,
+            population_size=config["Map"]["population_size"],
+            distance_factor=config["Map"]["distance_factor"],
+            collision_penalty=config["Map"]["collision_penalty"],
+            retain_percentage=config["Map"]["retain_percentage"],
+            random_select_chance=config["Map"]["random_select_chance"],
+            mutate_chance=config["Map"]["mutate_chance"],
+            init_workers=config.getint("Map", "init_workers", fallback=1),
+            max_init_attempts=config.getint("Map", "max_init_attempts", fallback=1000),
+            max_init_steps=config.getint("Map", "max_init_steps", fallback=1000),
+            cache_size=config.getint("Map", "cache_size", fallback=0),
+            progress=progress,
+            rng=RandomStream(int(seed) if seed else None))
+
+def convergence_detector(config):
+    """
+    Returns a convergence detector with the stop criteria selected by the config.
+
+    config: the parsed config file
+    """
+    confidence_level = int(config["Map"]["confidence_level"])
+    criteria = []
+    for name in config.get("Convergence", "criteria", fallback="plateau").split(","):
+        name = name.strip()
+        if name == "plateau":
+            criteria.append(Plateau(confidence_level))
+        elif name == "variance":
+            criteria.append(VarianceThreshold(
+                confidence_level,
+                config.getfloat("Convergence", "variance_threshold", fallback=0.01)))
+        elif name == "stagnation":
+            criteria.append(Stagnation(
+                config.getint("Convergence", "stagnation_generations", fallback=200),
+                config.getfloat("Convergence", "stagnation_tolerance", fallback=0)))
+        elif name == "time":
+            criteria.append(TimeBudget(
+                config.getfloat("Convergence", "time_budget", fallback=3600)))
+        elif name == "target":
+            criteria.append(TargetFitness(
+                config.getfloat("Convergence", "target_fitness", fallback=0)))
+        elif name:
+            raise Exception("Unsupported stop criterion: " + name)
+    return ConvergenceDetector(criteria)
+
+def rate_controller(config, log=None):
+    """
+    Returns the controller adapting the rates of the evolution as set up
+    in the config, or None if the rates are fixed.
+
+    config: the parsed config file
+    log: optional file for the decisions of the controller
+    """
+    if not config.getboolean("Adaptive", "enabled", fallback=False):
+        return None
+    return RateController(
+            config["Map"]["mutate_chance"],
+            config["Map"]["retain_percentage"],
+            config["Map"]["random_select_chance"],
+            window=config.getint("Adaptive", "window", fallback=20),
+            factor=config.getfloat("Adaptive", "factor", fallback=1.5),
+            max_change=config.getfloat("Adaptive", "max_change", fallback=4),
+            min_improvement=config.getfloat("Adaptive", "min_improvement", fallback=0.001),
+            diversity_threshold=config.getfloat("Adaptive", "diversity_threshold",
+                                                fallback=0.05),
+            log=log)
+
 class Interface():
     """Provides an interface to the simulation."""
 
-    def __init__(self):
+    def __init__(self, headless=False, updates_per_second=10):
+        """
+        Creates the interface.
+
+        headless: if set progress is reported as plain lines without
+                  terminal control sequences, e.g. for log files
+        updates_per_second: maximum rate of progress and status messages,
+                            0 disables the limit
+        """
         self.timestep_durations = CircularBuffer(10)
         self.write_durations = CircularBuffer(10)
         self.grade = 0
-        self.grades = []
+        self.grades = GradeHistory()
+        self.writer = None
+        self.svg_extension = ".svg"
+        self.headless = headless
+        self.update_interval = 1/updates_per_second if updates_per_second else 0
+        self.last_update = 0
+        self.max_timesteps = 0
 
     def __enter__(self):
         """Hides cursor."""
-        os.system("setterm -cursor off")
+        if not self.headless:
+            sys.stdout.write("\033[?25l")
+            sys.stdout.flush()
 
     def __exit__(self, *args):
         """Shows cursor again and writes final newline."""
-        os.system("setterm -cursor on")
+        if not self.headless:
+            sys.stdout.write("\033[?25h")
         sys.stdout.write("\n")
 
+    def _due(self, force=False):
+        """Returns whether the rate limit allows another message."""
+        now = time.monotonic()
+        if force or now - self.last_update >= self.update_interval:
+            self.last_update = now
+            return True
+        return False
+
     def init_msg(self, msg, ok, progress=0):
         """Convenience function for init messages."""
+        if not self._due(force=ok or progress == 0):
+            return
+        if self.headless:
+            if ok:
+                sys.stdout.write(msg + " ... OK\n")
+                sys.stdout.flush()
+            return
         dots_length = int((105 - len(msg)) * progress)
         msg = msg + " {} ".format("." * dots_length)
         if not ok:
@@ -53,11 +205,26 @@ class Interface():
 
     def status_msg(self, timestep, writing):
         """Convenience function for status messages."""
+        if not self._due(force=writing):
+            return
         timestep_mean = float(self.timestep_durations.average)
         write_mean    = float(self.write_durations.average)
+        # plots the background writer skipped because it fell behind
+        dropped = self.writer.dropped if self.writer else 0
+        if self.headless:
+            sys.stdout.write(("Timestep: {} Grade: {:.2f} {:.5f}s per Gen. "
+                              "{:.5f}s per file").format(timestep, self.grade,
+                                                         timestep_mean, write_mean))
+            if dropped:
+                sys.stdout.write(" {} plots dropped".format(dropped))
+            sys.stdout.write("\n")
+            sys.stdout.flush()
+            return
         string = ("\rCurrent timestep: {:>" + str(len(str(self.max_timesteps)) + 2) +
                   "d} -- Grade: {:>5.2f} -- {:>3.5f}s per Gen. "
                   "-- {:>3.5f}s per file").format(timestep, self.grade, timestep_mean, write_mean)
+        if dropped:
+            string += " -- {} dropped".format(dropped)
         if not writing:
             sys.stdout.write("{:120s}".format(string))
         else:
@@ -67,128 +234,270 @@ class Interface():
 
     def filename(self, timestep):
         """Picks the right filename for the SVG file"""
-        return ("test_{:0" + str(len(str(self.max_timesteps))) + "d}.svg").format(timestep)
+        return ("test_{:0" + str(len(str(self.max_timesteps))) + "d}"
+                + self.svg_extension).format(timestep)
 
 
     def save(self, timestep, map, tracks):
         """Saves plot of current population."""
-        self.status_msg(timestep, writing=True)
         if self.grade != 0:
             grade = self.grade
         else:
             grade = ""
+        if self.writer:
+            self.writer.save(self.filename(timestep), tracks, grade)
+            self.write_durations.extend(self.writer.finished())
+            return
+        self.status_msg(timestep, writing=True)
         with Timer() as write_timer:
             save_svg(self.filename(timestep), map, tracks, grade, out_directory=self.out_directory)
         write_duration = write_timer.elapsed
         self.write_durations.append(write_duration)
         self.status_msg(timestep, writing=False)
 
-    def run(self):
-        """Runs the simulation."""
-        parser = argparse.ArgumentParser(description="Simulates evolution"
-                                                        " for tracks on a given map.")
-        parser.add_argument("--config_file", help="file name of the config file",
-                            default="default.cfg")
-        args = parser.parse_args()
+    def save_solution(self, map, track, write_plots):
+        """Writes the acceleration vectors and optionally a plot of the best track."""
+        self.init_msg("Writing solution ...", ok=False)
+        if write_plots:
+            save_svg("solution" + self.svg_extension, map, [track], out_directory=self.out_directory)
+        with open(self.out_directory + "/solution", "w") as solution_file:
+            length = str(len(str(map.max_acceleration)) + 1)
+            for vector in track.acceleration_vectors:
+                solution_file.write(("({:>" + length + "d}, {:>" + length
+                                  + "d})\n").format(vector.x, vector.y))
+        self.init_msg("Writing solution", progress=1, ok=True)
+
+    def run(self, args=None):
+        """
+        Runs the simulation.
+
+        args: parsed command line arguments, read from sys.argv if not given
+        """
+        if args is None:
+            args = parse_arguments()
 
         self.init_msg("Reading config ...", ok=False)
         config = configparser.ConfigParser()
         if os.path.isfile(args.config_file):
             config.read(args.config_file)
             map_file_name = config["Map"]["filename"]
-            population_size = config["Map"]["population_size"]
             max_acceleration = config["Map"]["max_acceleration"]
-            distance_factor = config["Map"]["distance_factor"]
-            collision_penalty = config["Map"]["collision_penalty"]
-            retain_percentage = config["Map"]["retain_percentage"]
-            random_select_chance = config["Map"]["random_select_chance"]
-            mutate_chance = config["Map"]["mutate_chance"]
             self.max_timesteps = int(config["Map"]["max_timesteps"])
-            confidence_level = int(config["Map"]["confidence_level"])
+            history_chunk = config.getint("Convergence", "history_chunk", fallback=1000)
 
             write_plots = literal_eval(config["Plots"]["enabled"])
             self.out_directory = config["Plots"]["out_directory"]
             write_frequency = int(config["Plots"]["frequency"])
             clean_previous = literal_eval(config["Plots"]["clean_previous"])
             plot_grades = literal_eval(config["Plots"]["plot_grades"])
+            background_writer = config.getboolean("Plots", "background", fallback=False)
+            writer_queue_size = config.getint("Plots", "queue_size", fallback=2)
+            writer_when_busy = config.get("Plots", "when_busy", fallback="block")
+            if config.getboolean("Plots", "compress", fallback=False):
+                self.svg_extension = ".svgz"
+
+            stats.enabled = config.getboolean("Profiling", "enabled", fallback=False)
+            stats_file_name = config.get("Profiling", "stats_file", fallback="")
+
+            write_checkpoints = config.getboolean("Checkpoints", "enabled", fallback=False)
+            checkpoint_frequency = config.getint("Checkpoints", "frequency", fallback=10)
+            checkpoint_file_name = config.get("Checkpoints", "filename", fallback="checkpoint.npz")
+
+            islands = config.getint("Islands", "islands", fallback=1)
+            migration_interval = config.getint("Islands", "migration_interval", fallback=50)
+            migration_size = config.getint("Islands", "migration_size", fallback=5)
+
+            distance_field = config.getboolean("Distance", "enabled", fallback=False)
+            distance_cell_size = config.getint("Distance", "cell_size", fallback=0)
+            distance_cache = config.get("Distance", "cache_directory", fallback="")
+
+            solver_mode = config.get("Solver", "mode", fallback="evolve")
+            solver_stop = config.getboolean("Solver", "stop", fallback=True)
+            max_expansions = config.getint("Solver", "max_expansions", fallback=200000)
+            max_frontier = config.getint("Solver", "max_frontier", fallback=500000)
+            seed_copies = config.getint("Solver", "seed_copies", fallback=1)
+
+            adaptive_log_name = config.get("Adaptive", "log_file", fallback="")
         else:
             raise Exception("Config file " + args.config_file + " not found. Exiting.")
 
         self.init_msg("Reading config", progress=1, ok=True)
-        if clean_previous and os.path.exists(self.out_directory):
+        checkpoint_file_name = os.path.join(self.out_directory, checkpoint_file_name)
+        if args.resume and not os.path.isfile(checkpoint_file_name):
+            raise Exception("Checkpoint " + checkpoint_file_name + " not found. Exiting.")
+        if clean_previous and not args.resume and os.path.exists(self.out_directory):
             self.init_msg("Cleaning previous plots ...", ok=False)
-            os.system("rm -rf " + self.out_directory + "/*")
+            for entry in os.scandir(self.out_directory):
+                if entry.is_dir(follow_symlinks=False):
+                    shutil.rmtree(entry.path)
+                else:
+                    os.remove(entry.path)
             self.init_msg("Cleaning previous plots", progress=1, ok=True)
 
         map = Map(max_acceleration, map_file_name)
+        if distance_field:
+            self.init_msg("Computing distance field ...", ok=False)
+            map.use_distance_field(distance_cell_size, distance_cache)
+            self.init_msg("Computing distance field", progress=1, ok=True)
         if write_plots:
             self.init_msg("Saving map ...", ok=False)
-            save_svg("map.svg", map, out_directory=self.out_directory)
+            save_svg("map" + self.svg_extension, map, out_directory=self.out_directory)
             self.init_msg("Saving map", progress=1, ok=True)
+        solution = None
+        if solver_mode not in ("evolve", "astar", "seed"):
+            raise Exception("Unsupported solver mode: " + solver_mode)
+        if solver_mode == "astar" or (solver_mode == "seed" and not args.resume):
+            self.init_msg("Searching shortest track ...", ok=False)
+            solver = Solver(map, stop=solver_stop, max_expansions=max_expansions,
+                            max_frontier=max_frontier)
+            solution = solver.solve()
+            self.init_msg("Searching shortest track", progress=1, ok=True)
+            if solution is None:
+                print("No track found after {} expansions.".format(solver.expansions))
+            elif not solver.optimal:
+                print("The frontier was trimmed, the track might not be the shortest.")
+            if solver_mode == "astar":
+                if solution is not None:
+                    self.save_solution(map, solution, write_plots)
+                return
+        if write_plots and background_writer:
+            if writer_when_busy not in ("drop", "block"):
+                raise Exception("Unsupported when_busy policy: " + writer_when_busy)
+            self.writer = BackgroundWriter(map, self.out_directory,
+                                           queue_size=writer_queue_size,
+                                           block=writer_when_busy == "block")
+        arguments = population_arguments(
+                config, map,
+                progress=lambda progress: self.init_msg("Generating population",
+                                                        progress=progress, ok=False))
+        # set it as seed in the config to repeat the run
+        print("Seed: {}".format(arguments["rng"].entropy))
         self.init_msg("Generating population ", progress=0, ok=False)
-        population = Population(
-                map=map,
-                population_size=population_size,
-                distance_factor=distance_factor,
-                collision_penalty=collision_penalty,
-                retain_percentage=retain_percentage,
-                random_select_chance=random_select_chance,
-                mutate_chance=mutate_chance)
+        first_timestep = 1
+        if args.resume:
+            # the tracks are rebuilt from the checkpoint instead
+            arguments["population_size"] = 0
+        if islands > 1:
+            population = IslandPopulation(
+                    islands=islands,
+                    migration_interval=migration_interval,
+                    migration_size=migration_size,
+                    population_class=population_class(config),
+                    **arguments)
+        else:
+            population = population_class(config)(**arguments)
+        if solution is not None:
+            # every copy needs its own lists, mutations change them in place
+            tracks = population.tracks
+            copies = min(seed_copies, len(tracks))
+            tracks[len(tracks) - copies:] = [import_track(map, export_track(solution))
+                                             for _ in range(copies)]
+            population.tracks = tracks
         self.init_msg("Generating population", progress=1, ok=True)
+        detector = convergence_detector(config)
+        controller = rate_controller(config)
+        if args.resume:
+            self.init_msg("Loading checkpoint ...", ok=False)
+            population.tracks, last_timestep = load_checkpoint(
+                    checkpoint_file_name, map, population.rng, detector, controller)
+            first_timestep = last_timestep + 1
+            if islands > 1:
+                # migrate at the same generations as without the interruption
+                population.generation = last_timestep
+            if controller:
+                population.set_rates(**controller.rates)
+            self.init_msg("Loading checkpoint", progress=1, ok=True)
+        adaptive_log = None
+        if controller and adaptive_log_name:
+            if not os.path.exists(self.out_directory):
+                os.makedirs(self.out_directory)
+            adaptive_log_name = os.path.join(self.out_directory, adaptive_log_name)
+            if args.resume:
+                # decisions after the checkpoint are made again
+                truncate_log(adaptive_log_name, first_timestep - 1)
+            adaptive_log = open(adaptive_log_name, "a" if args.resume else "w")
+            controller.log = adaptive_log
+        # long histories are spilled next to the plots, a resumed run
+        # continues the spilled grades up to its checkpoint
+        self.grades = GradeHistory(history_chunk,
+                                   os.path.join(self.out_directory, "grades.bin"),
+                                   keep=first_timestep - 1)
+        detector.prime(self.grades)
         # write first plot
-        if write_plots:
+        if write_plots and not args.resume:
             self.save(0, map, population.tracks)
-        for i in range(1, self.max_timesteps + 1):
+        stats_file = None
+        if stats.enabled and stats_file_name:
+            stats_file = open(stats_file_name, "w")
+        i = first_timestep - 1
+        for i in range(first_timestep, self.max_timesteps + 1):
             self.status_msg(i, writing=False)
             with Timer() as timer:
                 self.grade = population.evolve()
             self.timestep_durations.append(timer.elapsed)
+            # stream stats of this generation
+            if stats_file:
+                stats.write_json_line(stats_file, generation=i, grade=self.grade,
+                                      duration=timer.elapsed)
+                stats.reset()
+            self.grades.append(self.grade)
+            # check if population changes and adapt the rates for the next
+            # generation, before the checkpoint includes them
+            converged = detector.update(i, self.grade, population.best_fitness)
+            if controller and controller.update(i, self.grade, population.best_fitness,
+                                                population.diversity):
+                population.set_rates(**controller.rates)
             # write plots regularly
-            self.grades.append((i, self.grade))
             if (write_plots and i % write_frequency == 0):
                 self.save(i, map, population.tracks)
-            # check if population changes
-            if len(self.grades) > confidence_level:
-                mean = (sum(y for (x,y) in self.grades[-confidence_level:])
-                        /confidence_level)
-                not_changing = True
-                for _, grade in self.grades[-confidence_level:]:
-                    if grade - mean > 1:
-                        not_changing = False
-                if not_changing:
-                    break
+            if (write_checkpoints and i % checkpoint_frequency == 0):
+                self.grades.flush()
+                save_checkpoint(checkpoint_file_name, population, i, detector,
+                                controller)
+            if converged:
+                break
 
 
+        self.grades.flush()
         # write final plot
+        tracks = population.tracks
+        population.close()
         if (write_plots and not (i % write_frequency == 0)):
-            self.save(i, map, population.tracks)
-        print("\nPopulation isn't changing anymore. Exiting ...")
+            self.save(i, map, tracks)
+        print("\n{}. Exiting ...".format(detector.reason or "Reached max_timesteps"))
+        if adaptive_log:
+            adaptive_log.close()
+        if stats_file:
+            stats_file.close()
+        elif stats.enabled:
+            # stats of the whole run
+            with open(self.out_directory + "/stats.json", "w") as summary_file:
+                stats.write_json_line(summary_file, generations=i)
+        if self.writer:
+            self.init_msg("Waiting for plots ...", ok=False)
+            self.writer.close()
+            message = "Waiting for plots"
+            if self.writer.dropped:
+                message += " ({} dropped, the writer fell behind)".format(
+                    self.writer.dropped)
+            self.init_msg(message, progress=1, ok=True)
         # write solution plot
-        self.init_msg("Writing solution ...", ok=False)
-        if write_plots:
-            save_svg("solution.svg", map, [population.tracks[0]], out_directory=self.out_directory)
-        with open(self.out_directory + "/solution", "w") as solution_file:
-            length = str(len(str(max_acceleration)) + 1)
-            for vector in population.tracks[0].acceleration_vectors:
-                solution_file.write(("({:>" + length + "d}, {:>" + length
-                                  + "d})\n").format(vector.x, vector.y))
-        self.init_msg("Writing solution", progress=1, ok=True)
+        self.save_solution(map, tracks[0], write_plots)
 
         if plot_grades:
+            self.init_msg("Plotting grades ...", ok=False)
             with open(self.out_directory + "/grades", "w") as grade_file:
                 for timestep, grade in self.grades:
                     string = ("{:>" + str(len(str(self.max_timesteps)))
                             + "} {:>4.5f}\n").format(timestep, grade)
                     grade_file.write(string)
-            with open(self.out_directory + "/plot", "w") as plot_file:
-                plot_file.write("set term pdf\n")
-                plot_file.write("set out '" + self.out_directory + "/grades.pdf'\n")
-                plot_file.write("set xlabel 'Timestep'\n")
-                plot_file.write("set ylabel ' Grade'\n")
-                plot_file.write("p '" + self.out_directory + "/grades' u 1:2 w l title 'Grades'\n")
-            os.system("gnuplot " + self.out_directory + "/plot")
+            save_grades_svg("grades" + self.svg_extension, self.grades,
+                            out_directory=self.out_directory)
+            self.init_msg("Plotting grades", progress=1, ok=True)
 
 if __name__ == "__main__":
-    interface = Interface()
+    args = parse_arguments()
+    interface = Interface(headless=args.headless,
+                          updates_per_second=args.updates_per_second)
     with interface:
-        interface.run()
+        interface.run(args)
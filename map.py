@@ -1,10 +1,55 @@
+import hashlib
+import os
+import struct
+import numpy as np
 from functools import reduce
 from collections import namedtuple
 from itertools import chain
 from graphics import save_svg
+from intersect import as_segment_array
+from spatial import WallGrid
+from distance import load_distance_field
+from math import sqrt
 
 Point = namedtuple("Point", ["x", "y"])
 
+# header of binary maps: magic, version, number of walls, start, target
+# and the bounds of walls, start and target, all little endian
+BINARY_MAGIC = b"EVRM"
+BINARY_VERSION = 1
+BINARY_HEADER = struct.Struct("<4sII2i2i4i")
+
+
+class Walls():
+    """
+    Read only sequence of (p, q) point tuples backed by an (n, 4) array.
+
+    The points are only created when a wall is accessed, so loading
+    a binary map allocates no objects per wall.
+    """
+
+    def __init__(self, array):
+        """
+        array: integer array of shape (n, 4)
+        """
+        self.array = array
+
+    def __repr__(self):
+        return repr(list(self))
+
+    def __len__(self):
+        return len(self.array)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        x1, y1, x2, y2 = self.array[index].tolist()
+        return (Point(x1, y1), Point(x2, y2))
+
+    def __iter__(self):
+        for x1, y1, x2, y2 in self.array.tolist():
+            yield (Point(x1, y1), Point(x2, y2))
+
 class Map():
     """
     Representing a map which contains walls, a starting point and a target.
@@ -18,11 +63,17 @@ class Map():
         filename: if given loads the map directly
         """
         self.map = list()
+        self._walls = None
+        self._index = None
+        self._boxes = None
+        self._checksum = None
+        self.filename = ""
         self.start = Point(0, 0)
         self.target = Point(0, 0)
         self.size_x = 0
         self.size_y = 0
         self.max_acceleration = int(max_acceleration)
+        self.distance_field = None
         if filename:
             self.load(filename)
 
@@ -36,25 +87,159 @@ class Map():
         p: line point
         q: line point
         """
+        if isinstance(self.map, Walls):
+            self.map = list(self.map)
         self.map.append((p, q))
+        self._walls = None
+        self._index = None
+        self._boxes = None
+        # the walls no longer match the file
+        self.filename = ""
+        self._checksum = None
+
+    @property
+    def walls(self):
+        """The walls as an integer array of shape (n, 4) for batch collision checks."""
+        if self._walls is None:
+            self._walls = as_segment_array(self.map)
+        return self._walls
+
+    @property
+    def boxes(self):
+        """
+        The bounding boxes of the walls as an integer array of shape (n, 4)
+        with the columns min_x, min_y, max_x, max_y.
+        """
+        if self._boxes is None:
+            walls = self.walls
+            self._boxes = np.hstack((np.minimum(walls[:, :2], walls[:, 2:]),
+                                     np.maximum(walls[:, :2], walls[:, 2:])))
+            self._box_list = [tuple(box) for box in self._boxes.tolist()]
+            if len(walls):
+                self._wall_bounds = (tuple(self._boxes[:, :2].min(axis=0).tolist())
+                                     + tuple(self._boxes[:, 2:].max(axis=0).tolist()))
+            else:
+                # nothing to hit, every segment lies outside
+                self._wall_bounds = (1, 1, 0, 0)
+        return self._boxes
+
+    @property
+    def box_list(self):
+        """The bounding boxes of the walls as a list of tuples for scalar checks."""
+        self.boxes
+        return self._box_list
+
+    @property
+    def checksum(self):
+        """
+        The SHA-256 checksum of the map file, None if the map wasn't
+        loaded from a file. Computed on first use.
+        """
+        if self._checksum is None and self.filename:
+            checksum = hashlib.sha256()
+            with open(self.filename, "rb") as map_file:
+                for block in iter(lambda: map_file.read(1 << 20), b""):
+                    checksum.update(block)
+            self._checksum = checksum.hexdigest()
+        return self._checksum
+
+    @property
+    def wall_bounds(self):
+        """The bounding box (min_x, min_y, max_x, max_y) of all walls."""
+        self.boxes
+        return self._wall_bounds
+
+    @property
+    def bounds(self):
+        """The bounding box (min_x, min_y, max_x, max_y) of the walls, start and target."""
+        points = np.vstack((self.walls.reshape(-1, 2), [self.start, self.target]))
+        low = points.min(axis=0).tolist()
+        high = points.max(axis=0).tolist()
+        return (low[0], low[1], high[0], high[1])
+
+    @property
+    def index(self):
+        """Spatial index over the walls, built on first use."""
+        if self._index is None:
+            self._index = WallGrid(self.walls)
+        return self._index
+
+    def candidate_walls(self, p, q):
+        """
+        Returns the indices of the walls which might intersect
+        the segment from p to q.
+
+        p: segment point
+        q: segment point
+        """
+        return self.index.query(p, q)
+
+    def use_distance_field(self, cell_size=0, cache_directory=""):
+        """
+        Measures distances to the target around the walls
+        instead of in a straight line from now on.
+
+        cell_size: the resolution of the distance field, 0 chooses it
+        cache_directory: folder in which computed fields are kept
+        """
+        self.distance_field = load_distance_field(self, cell_size, cache_directory)
+
+    def target_distance(self, point):
+        """
+        Returns the distance from a point to the target.
+
+        point: the point
+        """
+        if self.distance_field is not None:
+            return self.distance_field.distance(point)
+        distance_x = float(point.x - self.target.x)
+        distance_y = float(point.y - self.target.y)
+        return sqrt(distance_x * distance_x + distance_y * distance_y)
+
+    def target_distances(self, positions):
+        """
+        Vectorized version of target_distance.
+
+        positions: (n, 2) array of points
+        """
+        if self.distance_field is not None:
+            return self.distance_field.lookup(positions)
+        return np.hypot(positions[:, 0] - self.target.x,
+                        positions[:, 1] - self.target.y)
 
     def load(self, filename):
         """
-        Loads a map from a file.
+        Loads a map from a text or binary file.
 
         filename: the filename of the map file
         """
-        for line in open(filename):
+        with open(filename, "rb") as map_file:
+            magic = map_file.read(len(BINARY_MAGIC))
+            if magic == BINARY_MAGIC:
+                content = None
+            else:
+                content = magic + map_file.read()
+        if content is None:
+            self._load_binary(filename, os.path.getsize(filename))
+        else:
+            self._load_text(content.decode())
+        self.filename = filename
+        self._checksum = None
+        if len(self.map):
+            self.size_x = max(self.size_x, int(self.walls[:, [0, 2]].max()))
+            self.size_y = max(self.size_y, int(self.walls[:, [1, 3]].max()))
+        # build the spatial index and the wall boxes once instead of during
+        # the first query
+        self._index = WallGrid(self.walls)
+        self.boxes
+
+    def _load_text(self, content):
+        """Parses the lines of a text map."""
+        for line in content.splitlines(True):
             split_line = line.split()
             if line[0] == "#":
                 pass
             elif split_line[0].lower() == "w":
-                # update dimensions
-                self.size_x = max(self.size_x, int(split_line[1]))
-                self.size_x = max(self.size_x, int(split_line[3]))
-                self.size_y = max(self.size_x, int(split_line[2]))
-                self.size_y = max(self.size_x, int(split_line[4]))
-
                 p = Point(int(split_line[1]), int(split_line[2]))
                 q = Point(int(split_line[3]), int(split_line[4]))
                 self.add_line(p, q)
@@ -64,3 +249,54 @@ class Map():
                     self.target = Point(int(split_line[1]), int(split_line[2]))
             else:
                 raise Exception("Unsupported character at the beginning of line: " + line)
+
+    def _load_binary(self, filename, file_size):
+        """
+        Maps the walls of a binary map into memory and checks the header.
+
+        filename: the filename of the map file
+        file_size: the size of the file in bytes
+        """
+        if file_size < BINARY_HEADER.size:
+            raise Exception("Binary map " + filename + " is truncated.")
+        with open(filename, "rb") as map_file:
+            header = BINARY_HEADER.unpack(map_file.read(BINARY_HEADER.size))
+        magic, version, count = header[:3]
+        start, target, bounds = header[3:5], header[5:7], header[7:]
+        if version != BINARY_VERSION:
+            raise Exception("Unsupported binary map version: " + str(version))
+        if file_size != BINARY_HEADER.size + count * 16:
+            raise Exception("Binary map " + filename + " should contain " + str(count)
+                            + " walls, but has the wrong size.")
+        if count:
+            walls = np.memmap(filename, dtype="<i4", mode="r",
+                              offset=BINARY_HEADER.size, shape=(count, 4))
+        else:
+            walls = np.zeros((0, 4), dtype=np.int32)
+        self.map = Walls(walls)
+        self._walls = walls
+        self._index = None
+        self._boxes = None
+        self.start = Point(*start)
+        self.target = Point(*target)
+        if self.bounds != bounds:
+            raise Exception("Binary map " + filename + " has wrong bounds "
+                            + str(bounds) + ", expected " + str(self.bounds) + ".")
+
+    def save_binary(self, filename):
+        """
+        Saves the map in the binary format.
+
+        filename: the filename of the map file
+        """
+        walls = np.asarray(self.walls, dtype="<i4")
+        if not np.array_equal(walls, self.walls):
+            raise Exception("Map coordinates don't fit into 32 bit integers.")
+        header = BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, len(walls),
+                                    self.start.x, self.start.y,
+                                    self.target.x, self.target.y, *self.bounds)
+        temporary = filename + ".tmp"
+        with open(temporary, "wb") as map_file:
+            map_file.write(header)
+            map_file.write(walls.tobytes())
+        os.replace(temporary, filename)
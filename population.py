@@ -1,31 +1,77 @@
 # Based on code from http://lethain.com/genetic-algorithms-cool-name-damn-simple/
 
-from random import randint, random
 from operator import add
 from functools import reduce
-from math import sin, cos, pi, sqrt
-from track import Track, Vector
+from math import sin, cos, pi
+from track import Track, Vector, export_track, import_track, simulate
 from map import Point
-from operator import itemgetter
+from cache import LRUCache
+from rng import RandomStream
+from stats import stats
+import multiprocessing
+import numpy as np
+
+# number of individuals generated from one random stream during initialization
+INIT_CHUNK_SIZE = 16
+
+_worker_population = None
+
+def _init_worker(population):
+    """Pool initializer, stores the population once per worker process."""
+    global _worker_population
+    _worker_population = population
+
+def _generate_individuals(arguments):
+    """
+    Pool task, creates a chunk of individuals.
+
+    Every chunk brings its own random stream, so the result only depends
+    on the stream and not on which worker the chunk was scheduled to.
+
+    arguments: tuple of the RandomStream and the number of individuals
+    """
+    rng, count = arguments
+    return [export_track(_worker_population.individual(rng)) for _ in range(count)]
 
 class Population():
     """ A population of tracks."""
 
-    def individual(self):
-        """"Creates a member of the population."""
-        track = Track(self.map)
-        while track.accelerate(self.random_vector(), generating=True):
-            pass
+    def individual(self, rng=None):
+        """
+        Creates a member of the population.
+
+        A random track is restarted whenever it collides or gets longer
+        than max_init_steps. After max_init_attempts restarts the last
+        attempt is returned, even if it collided.
+
+        rng: the RandomStream to use instead of the one of the population
+        """
+        if rng is None:
+            rng = self.rng
+        for attempt in range(self.max_init_attempts):
+            track = Track(self.map, rng)
+            if simulate(track, (self.random_vector(rng)
+                                for _ in range(self.max_init_steps))):
+                # didn't stop near the target in time
+                continue
+            if not track.collision:
+                break
         return track
 
-    def random_vector(self):
-        """Returns a vector of random length and direction."""
+    def random_vector(self, rng=None):
+        """
+        Returns a vector of random length and direction.
+
+        rng: the RandomStream to use instead of the one of the population
+        """
+        if rng is None:
+            rng = self.rng
         vector = Vector(0, 0)
         while vector == Vector(0, 0):
             # choose angle
-            angle = random() * 2 * pi
+            angle = rng.random() * 2 * pi
             # choose length
-            length = random() * self.map.max_acceleration
+            length = rng.random() * self.map.max_acceleration
             x = int(sin(angle) * length)
             y = int(cos(angle) * length)
             vector = Vector(x, y)
@@ -33,7 +79,8 @@ class Population():
 
     def __init__(self, map, population_size, distance_factor,
                  collision_penalty, retain_percentage, random_select_chance,
-                 mutate_chance):
+                 mutate_chance, init_workers=1, max_init_attempts=1000,
+                 max_init_steps=1000, cache_size=0, progress=None, rng=None):
         """
         Creates a number of individuals (i.e. a population).
 
@@ -45,6 +92,18 @@ class Population():
                            should be retained during evolution
         random_select_chance: how many bad individuals should live on anyway
         mutate_chance: chance for randomly mutating some individuals
+        init_workers: number of processes generating the initial population,
+                      0 uses all cores
+        max_init_attempts: how often the generation of an individual is
+                           restarted before giving up
+        max_init_steps: the maximum length of a generated individual
+        cache_size: the number of simulated children to remember, 0 disables
+                    the cache
+        progress: optional callback receiving the generated fraction
+                  of the population
+        rng: the RandomStream of the population, freshly seeded if not given.
+             The initial population is generated in chunks with streams
+             spawned from it, so it doesn't depend on init_workers.
         """
         self.map = map
         self.distance_factor = float(distance_factor)
@@ -52,14 +111,38 @@ class Population():
         self.retain_percentage = float(retain_percentage)
         self.random_select_chance = float(random_select_chance)
         self.mutate_chance = float(mutate_chance)
-        self.tracks = []
-        # defered import to avoid circular import
-        from main import Interface
-        interface = Interface()
+        self.max_init_attempts = max(1, int(max_init_attempts))
+        self.max_init_steps = int(max_init_steps)
+        self.cache = LRUCache(cache_size)
+        self.rng = rng if rng is not None else RandomStream()
+        # best fitness and diversity seen by the last evolve
+        self.best_fitness = None
+        self.diversity = None
+        init_workers = int(init_workers) or multiprocessing.cpu_count()
+        tracks = []
+        if progress is None:
+            progress = lambda progress: None
         population_size = int(population_size)
-        for i in range(population_size):
-            interface.init_msg("Generating population", progress=float(i/population_size), ok=False)
-            self.tracks.append(self.individual())
+        chunks = [min(INIT_CHUNK_SIZE, population_size - i)
+                  for i in range(0, population_size, INIT_CHUNK_SIZE)]
+        chunks = list(zip(self.rng.spawn(len(chunks)), chunks))
+        if init_workers > 1 and population_size > 0:
+            with multiprocessing.Pool(init_workers, initializer=_init_worker,
+                                      initargs=(self,)) as pool:
+                for chunk in pool.imap(_generate_individuals, chunks):
+                    tracks.extend(import_track(self.map, state) for state in chunk)
+                    progress(float(len(tracks)/population_size))
+        else:
+            for rng, count in chunks:
+                for i in range(count):
+                    progress(float(len(tracks)/population_size))
+                    tracks.append(self.individual(rng))
+        self.tracks = tracks
+
+
+    def close(self):
+        """Releases resources held by the population."""
+        pass
 
 
     def fitness(self, individual):
@@ -68,10 +151,7 @@ class Population():
 
         individual: the individual to evaluate
         """
-        # calculate euclidean distance
-        distance_x = float(individual.positions[-1].x - self.map.target.x)
-        distance_y = float(individual.positions[-1].y - self.map.target.y)
-        distance = sqrt(distance_x * distance_x + distance_y * distance_y)
+        distance = self.map.target_distance(individual.positions[-1])
         # weight distance
         distance *= self.distance_factor
         length = len(individual.positions)
@@ -81,63 +161,167 @@ class Population():
         return distance + length + collision_penalty
 
 
-    def grade(self, population):
+    def fitnesses(self, last_positions, lengths, collisions):
+        """
+        Determine the fitness of many individuals at once. Lower is better.
+
+        Computes the same values as fitness.
+
+        last_positions: (n, 2) array of the last position of each individual
+        lengths: (n,) array of the number of positions of each individual
+        collisions: (n,) array of collision flags
+        """
+        distance = self.map.target_distances(last_positions)
+        return (distance * self.distance_factor + lengths +
+                collisions * self.collision_penalty)
+
+
+    def grade(self, fitness):
         """
         Find average fitness for the population.
 
-        population: graded population tuples
+        fitness: array of the fitness values of the population
+        """
+        return float(np.mean(fitness))
+
+
+    def spread(self, fitness):
+        """
+        Measures the diversity of the population as the coefficient of
+        variation of the fitness values, 0 if they are all the same.
+
+        fitness: array of the fitness values of the population
+        """
+        mean = float(np.mean(fitness)) if len(fitness) else 0.0
+        if mean <= 0:
+            return 0.0
+        return float(np.std(fitness)) / mean
+
+
+    def set_rates(self, mutate_chance, retain_percentage, random_select_chance):
+        """
+        Changes the rates of the evolution, e.g. as tuned by a RateController.
+
+        mutate_chance: chance for randomly mutating some individuals
+        retain_percentage: how much of the population
+                           should be retained during evolution
+        random_select_chance: how many bad individuals should live on anyway
+        """
+        self.mutate_chance = float(mutate_chance)
+        self.retain_percentage = float(retain_percentage)
+        self.random_select_chance = float(random_select_chance)
+
+
+    def select(self, fitness):
+        """
+        Splits the population into the retained elite and the rest.
+
+        Uses a partial selection instead of sorting the whole population.
+        Returns the indices of the elite, best individual first,
+        and the indices of the remaining individuals in no particular order.
+
+        fitness: array of the fitness values of the population
+        """
+        retain_length = int(len(fitness)*self.retain_percentage)
+        if retain_length >= len(fitness):
+            return np.argsort(fitness, kind="stable"), np.zeros(0, dtype=np.intp)
+        partitioned = np.argpartition(fitness, retain_length)
+        elite = partitioned[:retain_length]
+        elite = elite[np.argsort(fitness[elite], kind="stable")]
+        return elite, partitioned[retain_length:]
+
+
+    def crossover(self, male, female):
+        """
+        Creates a child from the first half of the male
+        and the second half of the female.
+
+        The simulation of children is cached, so recurring pairings
+        of the same parents are only simulated once.
+
+        male: the parent providing the beginning of the child
+        female: the parent providing the end of the child
         """
-        sum = 0
-        for fitness, _ in population:
-            sum += fitness
-        return sum/len(population)
+        half_male = int(len(male.positions) / 2)
+        half_female = int(len(female.positions) / 2)
+        # reuse the part of the male which is known to be collision free
+        prefix_length = min(half_male, len(male.positions) - male.collision)
+        prefix_acceleration_vectors = male.acceleration_vectors[:prefix_length]
+        child_positions = (male.positions[prefix_length:half_male] +
+            female.positions[half_female:] )
+        key = None
+        if self.cache.size > 0:
+            # the prefix is determined by its acceleration vectors
+            key = (tuple(prefix_acceleration_vectors), tuple(child_positions))
+            state = self.cache.get(key)
+            stats.count("cache_misses" if state is None else "cache_hits")
+            if state is not None:
+                # the points are immutable, only the lists need copies
+                positions, acceleration_vectors, velocity_vector, collision = state
+                child = Track(self.map, self.rng)
+                child.positions = list(positions)
+                child.acceleration_vectors = list(acceleration_vectors)
+                child.velocity_vector = velocity_vector
+                child.collision = collision
+                return child
+        child = Track(self.map, self.rng)
+        child.copy_prefix(male.positions[:prefix_length],
+                          prefix_acceleration_vectors)
+        child.approximate_positions(child_positions)
+        if key is not None:
+            self.cache.put(key, export_track(child))
+        return child
 
 
     def evolve(self):
         """Evolves the population."""
-        graded = [ (self.fitness(x), x) for x in self.tracks ]
-        grade = self.grade(graded)
-        graded = [ x[1] for x in sorted(graded, key=itemgetter(0)) ]
-        retain_length = int(len(graded)*self.retain_percentage)
-        parents = graded[:retain_length]
+        stats.count("generations")
+        with stats.phase("grading"):
+            fitness = self.fitnesses(
+                np.array([x.positions[-1] for x in self.tracks]).reshape(-1, 2),
+                np.array([len(x.positions) for x in self.tracks]),
+                np.array([x.collision for x in self.tracks]))
+            grade = self.grade(fitness)
+            self.best_fitness = float(fitness.min()) if len(fitness) else None
+            self.diversity = self.spread(fitness)
+        with stats.phase("sorting"):
+            elite, rest = self.select(fitness)
+        with stats.phase("selection"):
+            parents = [self.tracks[i] for i in elite]
 
-        # randomly add other individuals to promote genetic diversity
-        for individual in graded[retain_length:]:
-            if self.random_select_chance > random():
-                parents.append(individual)
+            # randomly add other individuals to promote genetic diversity
+            for i in rest:
+                if self.random_select_chance > self.rng.random():
+                    parents.append(self.tracks[i])
 
         # mutate some individuals
-        for i, _ in enumerate(parents):
-            if self.mutate_chance > random():
-                pos_to_mutate = randint(0, len(parents[i].positions) - 1)
-                mutated_positions = parents[i].positions
-                point_x = randint(0, self.map.size_x)
-                point_y = randint(0, self.map.size_y)
-                mutated_positions[pos_to_mutate] = Point(point_x, point_y)
-                mutated_individual = Track(self.map)
-                mutated_individual.approximate_positions(mutated_positions)
-                parents[i] = mutated_individual
+        with stats.phase("mutation"):
+            for i, _ in enumerate(parents):
+                if self.mutate_chance > self.rng.random():
+                    stats.count("mutations")
+                    pos_to_mutate = self.rng.randint(0, len(parents[i].positions) - 1)
+                    mutated_positions = parents[i].positions
+                    point_x = self.rng.randint(0, self.map.size_x)
+                    point_y = self.rng.randint(0, self.map.size_y)
+                    mutated_positions[pos_to_mutate] = Point(point_x, point_y)
+                    mutated_individual = Track(self.map, self.rng)
+                    mutated_individual.approximate_positions(mutated_positions)
+                    parents[i] = mutated_individual
 
 
         # crossover parents to create children
-        parents_length = len(parents)
-        desired_length = len(self.tracks) - parents_length
-        children = []
-        for i in range(desired_length):
-            male = 0
-            female = 0
-            while male == female:
-                male = randint(0, parents_length - 1)
-                female = randint(0, parents_length - 1)
-            male = parents[male]
-            female = parents[female]
-            half_male = int(len(male.positions) / 2)
-            half_female = int(len(female.positions) / 2)
-            child_positions = (male.positions[:half_male] +
-                female.positions[half_female:] )
-            child = Track(self.map)
-            child.approximate_positions(child_positions)
-            children.append(child)
+        with stats.phase("crossover"):
+            parents_length = len(parents)
+            desired_length = len(self.tracks) - parents_length
+            children = []
+            for i in range(desired_length):
+                male = 0
+                female = 0
+                while male == female:
+                    male = self.rng.randint(0, parents_length - 1)
+                    female = self.rng.randint(0, parents_length - 1)
+                children.append(self.crossover(parents[male], parents[female]))
+            stats.count("children", desired_length)
 
         parents.extend(children)
         self.tracks = parents
@@ -0,0 +1,75 @@
+import random
+import numpy as np
+
+
+class RandomStream(random.Random):
+    """
+    The random numbers of a run, or of one of its workers.
+
+    It is a random.Random for the scalar code with a numpy Generator
+    in the numpy attribute for the vectorized code. Both are seeded from
+    one numpy SeedSequence, so a stream is reproduced exactly by its seed
+    and the streams created by spawn are independent of each other and of
+    their parent, no matter in which process or order they are used.
+    """
+
+    def __init__(self, seed=None):
+        """
+        Creates the stream.
+
+        seed: an integer, a numpy SeedSequence or None for a fresh seed
+        """
+        if not isinstance(seed, np.random.SeedSequence):
+            seed = np.random.SeedSequence(seed)
+        self.sequence = seed
+        python_sequence, numpy_sequence = seed.spawn(2)
+        super().__init__(int.from_bytes(python_sequence.generate_state(8).tobytes(),
+                                        "little"))
+        self.numpy = np.random.Generator(np.random.PCG64(numpy_sequence))
+
+    def __repr__(self):
+        return "Seed: {} Spawn key: {}".format(self.entropy, self.sequence.spawn_key)
+
+    @property
+    def entropy(self):
+        """The seed of the stream, or of the stream it was spawned from."""
+        return self.sequence.entropy
+
+    def spawn(self, count):
+        """
+        Returns independent child streams, e.g. one for every worker.
+
+        count: the number of streams
+        """
+        return [RandomStream(sequence) for sequence in self.sequence.spawn(count)]
+
+    def getstate(self):
+        """
+        Returns the state of the stream, also used for pickling.
+
+        The state only consists of dictionaries, sequences and numbers,
+        so it can be stored as JSON.
+        """
+        return dict(python=super().getstate(),
+                    numpy=self.numpy.bit_generator.state,
+                    entropy=self.sequence.entropy,
+                    spawn_key=self.sequence.spawn_key,
+                    spawned=self.sequence.n_children_spawned)
+
+    def setstate(self, state):
+        """
+        Restores a state returned by getstate.
+
+        state: the state, its tuples may have become lists
+        """
+        version, internal_state, gauss_next = state["python"]
+        super().setstate((version, tuple(internal_state), gauss_next))
+        self.sequence = np.random.SeedSequence(state["entropy"],
+                                               spawn_key=tuple(state["spawn_key"]),
+                                               n_children_spawned=state["spawned"])
+        self.numpy = np.random.Generator(np.random.PCG64())
+        self.numpy.bit_generator.state = state["numpy"]
+
+
+# used by tracks and functions which weren't given a stream
+default_stream = RandomStream()
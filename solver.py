@@ -0,0 +1,232 @@
+import heapq
+from itertools import count
+import numpy as np
+from map import Point
+from intersect import batch_intersect
+from track import replay_track
+from stats import stats
+
+
+def acceleration_vectors(max_acceleration):
+    """
+    Returns all acceleration vectors a track can use as an (n, 2) array.
+
+    These are the integer vectors not longer than max_acceleration,
+    exactly the vectors Track.limit_vector leaves untouched.
+
+    max_acceleration: the maximum acceleration allowed on the map
+    """
+    a = int(max_acceleration)
+    x, y = np.mgrid[-a:a + 1, -a:a + 1]
+    vectors = np.stack((x.ravel(), y.ravel()), axis=1).astype(np.int64)
+    return vectors[(vectors * vectors).sum(axis=1) <= a * a]
+
+
+class Solver():
+    """
+    Searches the shortest track with A* over the (position, velocity) states.
+
+    A step applies one acceleration vector, so the cost of a track is its
+    number of steps. The heuristic is the smallest number of steps in which
+    the target could be reached, and the car stopped, if there were no
+    walls: after n steps the position differs from position + n * velocity
+    by at most max_acceleration * n(n+1)/2 and the velocity can change by at
+    most max_acceleration * n. It never overestimates, so the first track
+    reaching the target is a shortest one.
+
+    The moves are tested against the walls with the same rules as
+    do_intersect. States outside of the bounding box of the map are not
+    explored.
+    """
+
+    def __init__(self, map, stop=True, max_expansions=200000, max_frontier=500000):
+        """
+        Creates the solver.
+
+        map: the map to solve
+        stop: if set the car has to stand still on the target,
+              like the tracks of the population which brake at the end
+        max_expansions: the number of states to expand before giving up,
+                        0 for no limit
+        max_frontier: the number of states waiting to be expanded. If there
+                      are more, the worse half is forgotten and the result
+                      is no longer guaranteed to be optimal. 0 for no limit
+        """
+        if map.max_acceleration < 1:
+            raise Exception("The solver needs a max_acceleration of at least 1.")
+        self.map = map
+        self.stop = stop
+        self.max_expansions = int(max_expansions)
+        self.max_frontier = int(max_frontier)
+        self.accelerations = acceleration_vectors(map.max_acceleration)
+        min_x, min_y, max_x, max_y = map.bounds
+        self.low = np.array([min_x, min_y])
+        self.high = np.array([max_x, max_y])
+        self.expansions = 0
+        self.optimal = True
+
+    def __repr__(self):
+        return "Expansions: {} Optimal: {}".format(self.expansions, self.optimal)
+
+    def heuristic(self, positions, velocities):
+        """
+        Returns the minimum number of steps to the target for many states.
+
+        positions: (n, 2) array of positions
+        velocities: (n, 2) array of velocities
+        """
+        a = self.map.max_acceleration
+        distances = np.array(self.map.target, dtype=np.int64) - positions
+        distance = np.hypot(distances[:, 0], distances[:, 1])
+        speed = np.hypot(velocities[:, 0], velocities[:, 1])
+        # |distances - n * velocities| >= distance - n * speed, so no n below
+        # the root of a/2 n^2 + (a/2 + speed) n - distance can work
+        b = a/2 + speed
+        steps = np.floor((np.sqrt(b * b + 2 * a * distance) - b)/a).astype(np.int64)
+        if self.stop:
+            steps = np.maximum(steps, np.floor(speed/a).astype(np.int64))
+        steps = np.maximum(steps - 1, 0)
+        # count up from the estimate until the exact condition holds
+        pending = np.arange(len(positions))
+        while len(pending):
+            n = steps[pending]
+            rest = distances[pending] - n[:, None] * velocities[pending]
+            reach = a * n * (n + 1) // 2
+            done = (rest * rest).sum(axis=1) <= reach * reach
+            if self.stop:
+                done &= (velocities[pending] ** 2).sum(axis=1) <= (a * n) ** 2
+                for axis in (0, 1):
+                    done &= self._stops_at(distances[pending, axis],
+                                           velocities[pending, axis], n)
+            pending = pending[~done]
+            steps[pending] += 1
+        return steps
+
+    def _stops_at(self, distances, velocities, n):
+        """
+        Returns whether a car could cover the distances along one axis
+        and stand still after exactly n steps, allowing any acceleration
+        between -max_acceleration and max_acceleration on this axis.
+
+        distances: array of the distances to go along the axis
+        velocities: array of the velocities along the axis
+        n: array of the numbers of steps
+        """
+        a = self.map.max_acceleration
+        feasible = np.abs(velocities) <= a * n
+        # the acceleration of step i moves the car by (n - i + 1) times
+        # itself, the accelerations have to sum up to -velocities
+        lowest = n * velocities - self._furthest(n, velocities)
+        highest = n * velocities + self._furthest(n, -velocities)
+        return feasible & (lowest <= distances) & (distances <= highest)
+
+    def _furthest(self, n, total):
+        """
+        Returns the largest sum of (n - i + 1) * acceleration_i of n
+        accelerations between -max_acceleration and max_acceleration
+        which add up to total.
+        """
+        a = self.map.max_acceleration
+        # shift the accelerations to 0..2a and give the largest weights
+        # as much as possible
+        shifted = np.clip(total + n * a, 0, 2 * n * a)
+        full = shifted // (2 * a)
+        rest = shifted - full * 2 * a
+        weights = 2 * a * (full * n - full * (full - 1) // 2) + rest * (n - full)
+        return weights - a * n * (n + 1) // 2
+
+    def successors(self, position, velocity):
+        """
+        Returns the positions and velocities reachable in one step
+        without leaving the map or hitting a wall, and the acceleration
+        vectors leading there.
+
+        position: (x, y) tuple
+        velocity: (x, y) tuple
+        """
+        velocities = self.accelerations + velocity
+        positions = velocities + position
+        inside = ((positions >= self.low) & (positions <= self.high)).all(axis=1)
+        accelerations = self.accelerations[inside]
+        velocities = velocities[inside]
+        positions = positions[inside]
+        if len(positions):
+            # one query for the bounding box of all moves
+            low = positions.min(axis=0).tolist()
+            high = positions.max(axis=0).tolist()
+            candidates = self.map.candidate_walls(
+                Point(min(low[0], position[0]), min(low[1], position[1])),
+                Point(max(high[0], position[0]), max(high[1], position[1])))
+            if candidates:
+                segments = np.empty((len(positions), 4), dtype=np.int64)
+                segments[:, :2] = position
+                segments[:, 2:] = positions
+                free = ~batch_intersect(segments, self.map.walls[candidates])
+                accelerations = accelerations[free]
+                velocities = velocities[free]
+                positions = positions[free]
+        return positions, velocities, accelerations
+
+    def solve(self):
+        """
+        Runs the search. Returns the shortest track found or None
+        if the target can't be reached within the limits.
+        """
+        self.expansions = 0
+        self.optimal = True
+        start = (self.map.start.x, self.map.start.y, 0, 0)
+        target = (self.map.target.x, self.map.target.y)
+        # state -> (steps, parent state, acceleration vector)
+        known = {start: (0, None, None)}
+        expanded = set()
+        tie_breaker = count()
+        h = int(self.heuristic(np.array([start[:2]]), np.array([start[2:]]))[0])
+        frontier = [(h, 0, next(tie_breaker), start)]
+        while frontier:
+            f, negative_steps, _, state = heapq.heappop(frontier)
+            steps = -negative_steps
+            if state in expanded or known[state][0] < steps:
+                continue
+            if state[:2] == target and (not self.stop or state[2:] == (0, 0)):
+                stats.count("solver_expansions", self.expansions)
+                return self._track(known, state)
+            if self.max_expansions and self.expansions >= self.max_expansions:
+                break
+            expanded.add(state)
+            self.expansions += 1
+            positions, velocities, accelerations = self.successors(state[:2], state[2:])
+            estimates = self.heuristic(positions, velocities)
+            for child, acceleration, estimate in zip(
+                    np.hstack((positions, velocities)).tolist(), accelerations.tolist(),
+                    estimates.tolist()):
+                child = tuple(child)
+                if child in expanded or (child in known and known[child][0] <= steps + 1):
+                    continue
+                known[child] = (steps + 1, state, tuple(acceleration))
+                heapq.heappush(frontier, (steps + 1 + estimate, -(steps + 1),
+                                          next(tie_breaker), child))
+            if self.max_frontier and len(frontier) > self.max_frontier:
+                self._trim(frontier, known, expanded)
+        stats.count("solver_expansions", self.expansions)
+        return None
+
+    def _trim(self, frontier, known, expanded):
+        """Forgets the worse half of the frontier to bound the memory usage."""
+        self.optimal = False
+        keep = heapq.nsmallest(self.max_frontier // 2, frontier)
+        kept = set(entry[3] for entry in keep)
+        for entry in frontier:
+            state = entry[3]
+            if state not in kept and state not in expanded:
+                known.pop(state, None)
+        frontier[:] = keep
+        heapq.heapify(frontier)
+
+    def _track(self, known, state):
+        """Follows the parents back to the start and replays the track."""
+        accelerations = []
+        while known[state][1] is not None:
+            _, state, acceleration = known[state]
+            accelerations.append(acceleration)
+        accelerations.append((0, 0))
+        return replay_track(self.map, accelerations[::-1])
@@ -0,0 +1,146 @@
+from math import ceil, sqrt
+import numpy as np
+from intersect import as_segment_array
+
+
+def _expand(low_x, high_x, low_y, high_y):
+    """
+    Enumerates the cells of many cell ranges at once.
+
+    Returns the arrays (rows, cells_x, cells_y) with an entry for every
+    cell of every range, rows being the index of its range.
+    """
+    height = high_y - low_y + 1
+    counts = (high_x - low_x + 1) * height
+    rows = np.repeat(np.arange(len(counts)), counts)
+    local = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return rows, low_x[rows] + local // height[rows], low_y[rows] + local % height[rows]
+
+
+class WallGrid():
+    """
+    A uniform grid over the walls of a map.
+
+    Every wall is registered in all cells its bounding box touches, so a
+    query only has to look at the cells touched by the bounding box of
+    the queried segment.
+
+    Besides the dictionary of cells for single queries the walls of all
+    cells are kept in flat arrays, the walls of a cell being
+    walls[starts[cell]:starts[cell + 1]], for queries of many segments.
+    """
+
+    def __init__(self, walls, cell_size=0):
+        """
+        Creates the grid.
+
+        walls: sequence of (p, q) point tuples or an (n, 4) array
+        cell_size: edge length of a cell, chosen from the walls if not given
+        """
+        self.cells = dict()
+        self.min_x = self.min_y = self.max_x = self.max_y = 0
+        self.size_x = self.size_y = 0
+        self.starts = np.zeros(1, dtype=np.intp)
+        self.walls = np.zeros(0, dtype=np.intp)
+        walls = as_segment_array(walls)
+        if len(walls) == 0:
+            self.cell_size = max(1, int(cell_size))
+            return
+        xs = walls[:, 0::2]
+        ys = walls[:, 1::2]
+        self.min_x, self.max_x = int(xs.min()), int(xs.max())
+        self.min_y, self.max_y = int(ys.min()), int(ys.max())
+        if not cell_size:
+            # roughly sqrt(n) cells per side, i.e. about one cell per wall
+            extent = max(self.max_x - self.min_x, self.max_y - self.min_y)
+            cell_size = ceil(extent / sqrt(len(walls)))
+        self.cell_size = max(1, int(cell_size))
+        # the cell ranges of all walls at once, the walls define the bounds
+        low_x = xs.min(axis=1) // self.cell_size
+        high_x = xs.max(axis=1) // self.cell_size
+        low_y = ys.min(axis=1) // self.cell_size
+        high_y = ys.max(axis=1) // self.cell_size
+        for index, (x1, x2, y1, y2) in enumerate(zip(low_x.tolist(), high_x.tolist(),
+                                                     low_y.tolist(), high_y.tolist())):
+            for cell_x in range(x1, x2 + 1):
+                for cell_y in range(y1, y2 + 1):
+                    self.cells.setdefault((cell_x, cell_y), []).append(index)
+        # the same registration as flat arrays, the cells counted from the
+        # cell of (min_x, min_y)
+        self.base_x = self.min_x // self.cell_size
+        self.base_y = self.min_y // self.cell_size
+        self.size_x = self.max_x // self.cell_size - self.base_x + 1
+        self.size_y = self.max_y // self.cell_size - self.base_y + 1
+        rows, cells_x, cells_y = _expand(low_x - self.base_x, high_x - self.base_x,
+                                         low_y - self.base_y, high_y - self.base_y)
+        cells = cells_x * self.size_y + cells_y
+        order = np.argsort(cells, kind="stable")
+        self.walls = rows[order]
+        self.starts = np.zeros(self.size_x * self.size_y + 1, dtype=np.intp)
+        np.cumsum(np.bincount(cells, minlength=self.size_x * self.size_y),
+                  out=self.starts[1:])
+
+    def __repr__(self):
+        return "Cell size: {} Cells: {}".format(self.cell_size, len(self.cells))
+
+    def _cells(self, x1, y1, x2, y2):
+        """
+        Yields the cells touched by the bounding box of a segment.
+
+        Cells outside of the walls' bounding box are never yielded.
+        """
+        low_x = max(min(x1, x2), self.min_x)
+        high_x = min(max(x1, x2), self.max_x)
+        low_y = max(min(y1, y2), self.min_y)
+        high_y = min(max(y1, y2), self.max_y)
+        if low_x > high_x or low_y > high_y:
+            return
+        for cell_x in range(low_x // self.cell_size, high_x // self.cell_size + 1):
+            for cell_y in range(low_y // self.cell_size, high_y // self.cell_size + 1):
+                yield (cell_x, cell_y)
+
+    def query(self, p, q):
+        """
+        Returns the sorted indices of all walls which might intersect
+        the segment from p to q.
+
+        p: segment point
+        q: segment point
+        """
+        return self.candidates(p.x, p.y, q.x, q.y)
+
+    def candidate_pairs(self, segments):
+        """
+        Vectorized version of candidates for many segments.
+
+        Returns the arrays (segment_rows, wall_rows) of all pairs of a
+        segment and a wall which might intersect. A pair may occur more
+        than once if the wall lies in several of the segment's cells.
+
+        segments: (n, 4) integer array of segments
+        """
+        if len(self.walls) == 0 or len(segments) == 0:
+            return np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.intp)
+        low_x = np.maximum(np.minimum(segments[:, 0], segments[:, 2]), self.min_x)
+        high_x = np.minimum(np.maximum(segments[:, 0], segments[:, 2]), self.max_x)
+        low_y = np.maximum(np.minimum(segments[:, 1], segments[:, 3]), self.min_y)
+        high_y = np.minimum(np.maximum(segments[:, 1], segments[:, 3]), self.max_y)
+        inside = np.flatnonzero((low_x <= high_x) & (low_y <= high_y))
+        rows, cells_x, cells_y = _expand(
+            low_x[inside] // self.cell_size - self.base_x,
+            high_x[inside] // self.cell_size - self.base_x,
+            low_y[inside] // self.cell_size - self.base_y,
+            high_y[inside] // self.cell_size - self.base_y)
+        cells = cells_x * self.size_y + cells_y
+        firsts = self.starts[cells]
+        counts = self.starts[cells + 1] - firsts
+        local = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        wall_rows = self.walls[np.repeat(firsts, counts) + local]
+        return inside[np.repeat(rows, counts)], wall_rows
+
+    def candidates(self, x1, y1, x2, y2):
+        """Like query, but takes the plain coordinates of the segment."""
+        candidates = set()
+        for cell in self._cells(x1, y1, x2, y2):
+            candidates.update(self.cells.get(cell, ()))
+        return sorted(candidates)
@@ -0,0 +1,79 @@
+import json
+from collections import defaultdict
+from contextlib import contextmanager
+from time import perf_counter
+
+
+class Stats():
+    """
+    Collects timings and counters of the hot paths of the evolution.
+
+    Collecting is disabled by default, so the hooks cost next to nothing
+    unless profiling was requested.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.reset()
+
+    def __repr__(self):
+        return json.dumps(self.as_dict(), sort_keys=True)
+
+    def reset(self):
+        """Clears all timings and counters."""
+        self.timings = defaultdict(float)
+        self.counters = defaultdict(int)
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Context manager adding the time spent inside to a phase.
+
+        name: the name of the phase
+        """
+        if not self.enabled:
+            yield
+            return
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] += perf_counter() - start
+
+    def count(self, name, value=1):
+        """
+        Increments a counter.
+
+        name: the name of the counter
+        value: the increment
+        """
+        if self.enabled:
+            self.counters[name] += value
+
+    def merge(self, other):
+        """
+        Adds the timings and counters of a dictionary created by as_dict.
+
+        other: the dictionary to add
+        """
+        for name, value in other["timings"].items():
+            self.timings[name] += value
+        for name, value in other["counters"].items():
+            self.counters[name] += value
+
+    def as_dict(self):
+        """Returns the timings and counters as a dictionary."""
+        return {"timings": dict(self.timings), "counters": dict(self.counters)}
+
+    def write_json_line(self, file, **extra):
+        """
+        Writes the timings and counters as a single JSON line.
+
+        file: the file to write to
+        extra: further values to include, e.g. the generation
+        """
+        file.write(json.dumps(dict(extra, **self.as_dict()), sort_keys=True) + "\n")
+
+
+# collector shared by all populations and tracks of a process
+stats = Stats()
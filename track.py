@@ -1,23 +1,32 @@
 from collections import namedtuple
+import numpy as np
 from map import Map, Point
-from intersect import do_intersect
+from intersect import do_intersect, batch_intersect, intersect_pairs, BATCH_MIN_PAIRS
 from graphics import save_svg
+from stats import stats
 from math import sqrt
-from random import random
+from rng import default_stream
 
 Vector = namedtuple("Vector", ["x", "y"])
 
+# up to this number of walls the broad phase of simulate_batch compares
+# all bounding boxes at once instead of asking the spatial index
+BATCH_BOX_WALLS = 16
+
 
 class Track():
     """Represents a track a car could take across the map."""
 
-    def __init__(self, map):
+    def __init__(self, map, rng=None):
         """
         Creates a track.
 
         map: the map on which the track should be
+        rng: the RandomStream used for random braking, a shared
+             default stream if not given
         """
         self.map = map
+        self.rng = rng if rng is not None else default_stream
         self.velocity_vector = Vector(0, 0)
         self.acceleration_vectors = [Vector(0,0)]
         self.positions = [map.start]
@@ -28,15 +37,8 @@ class Track():
 
     def limit_vector(self, vector):
         """Limits the vector if longer than max_acceleration."""
-        length = sqrt(vector.x * vector.x + vector.y * vector.y)
-        if length > self.map.max_acceleration:
-            vector_x = int(vector.x * 1/length *
-                           self.map.max_acceleration)
-            vector_y = int(vector.y * 1/length *
-                           self.map.max_acceleration)
-            return Vector(vector_x, vector_y)
-        else:
-            return vector
+        x, y = _limit(vector.x, vector.y, self.map.max_acceleration)
+        return Vector(x, y)
 
 
     def brake_vector(self):
@@ -46,55 +48,28 @@ class Track():
 
     def distance(self):
         """
-        Calcualtes the euclidean distance
-        from the last position to the target.
+        Calcualtes the distance from the last position to the target,
+        around the walls if the map has a distance field.
         """
-        dist_x = self.positions[-1].x - self.map.target.x
-        dist_y = self.positions[-1].y - self.map.target.y
-        return sqrt(dist_x * dist_x + dist_y * dist_y)
+        return self.map.target_distance(self.positions[-1])
 
 
 
-    def accelerate(self, vector, check=True, random_braking=True, generating=False, _braking=False):
+    def accelerate(self, vector, check=True, random_braking=True, generating=False):
         """
         Accelerate into the given direction.
 
+        Returns False if the track stopped, i.e. braked or collided.
+
         vector: acceleration vector
         check: if set the function checks if further acceleration is
             possible/necessary
         random_braking: if set the function randomly breaks the nearer
             the track gets to the target
         generating: if set the function will reset the track if it collides
-        _braking: internal parameter
         """
-        vector = self.limit_vector(vector)
-        self.acceleration_vectors.append(vector)
-        self.velocity_vector = Vector(self.velocity_vector.x + vector.x,
-                                      self.velocity_vector.y + vector.y)
-        new_position = Point(self.positions[-1].x + self.velocity_vector.x,
-                             self.positions[-1].y + self.velocity_vector.y)
-        self.positions.append(new_position)
-        if check:
-            if _braking:
-                if self.velocity_vector == Vector(0, 0):
-                    return False
-                else:
-                    self.accelerate(self.brake_vector(), _braking=True)
-            # brake if near enough to the target
-            elif (self.distance() < self.map.max_acceleration * 2.5) and random_braking:
-                if ((-1/(self.map.max_acceleration * 2.5)) * self.distance() + 1) > random():
-                    self.accelerate(self.brake_vector(), _braking=True)
-                else:
-                    return True
-            elif self.check_collisions(len(self.positions) - 1):
-                if generating:
-                    self.__init__(self.map)
-                    return True
-                else:
-                    self.collision = True
-                    return False
-            else:
-                return True
+        return simulate(self, (vector,), check=check, random_braking=random_braking,
+                        generating=generating)
 
 
     def check_collisions(self, from_position_index=1, verbose=False):
@@ -104,29 +79,412 @@ class Track():
         from_position_index: check only position from this index
         verbose: verbosity flag
         """
-        for i in range(from_position_index, len(self.positions)):
-            for wall in self.map.map:
-                if do_intersect((self.positions[i-1], self.positions[i]),
-                                 wall):
-                    if verbose:
-                        print("Collision detected.")
-                    return True
+        positions = self.positions[max(from_position_index - 1, 0):]
+        for p, q in zip(positions, positions[1:]):
+            if _collides(self.map, p.x, p.y, q.x, q.y):
+                if verbose:
+                    print("Collision detected.")
+                return True
 
         if verbose:
             print("No collision detected.")
         return False
 
 
+    def copy_prefix(self, positions, acceleration_vectors):
+        """
+        Starts a new track with the already validated beginning of another
+        track instead of simulating it again.
+
+        Results in the same state as approximate_positions(positions),
+        except for the chance of random braking along the way.
+
+        positions: the first positions of the other track, which must not
+                   include its collision
+        acceleration_vectors: the matching acceleration vectors
+        """
+        self.positions.extend(positions)
+        self.acceleration_vectors.extend(acceleration_vectors)
+        if len(positions) > 1:
+            self.velocity_vector = Vector(positions[-1].x - positions[-2].x,
+                                          positions[-1].y - positions[-2].y)
+
+
     def approximate_positions(self, positions):
         """
         Tries to accelerate in such a way to reach the given positions.
+
+        positions: sequence of points or (x, y) pairs
         """
-        for position in positions:
-            # calculate the acceleration vector to the next position
-            accelerate_vector_x = (-self.positions[-1].x
-                - self.velocity_vector.x + position.x)
-            accelerate_vector_y = (-self.positions[-1].y
-                - self.velocity_vector.y + position.y)
-            if not self.accelerate(
-                Vector(accelerate_vector_x, accelerate_vector_y)):
+        simulate(self, positions, approximate=True)
+
+
+def _limit(x, y, max_acceleration):
+    """Limits the vector (x, y) if longer than max_acceleration."""
+    if x * x + y * y > max_acceleration * max_acceleration:
+        length = sqrt(x * x + y * y)
+        return (int(x * 1/length * max_acceleration),
+                int(y * 1/length * max_acceleration))
+    return (x, y)
+
+
+def _collides(map, x1, y1, x2, y2):
+    """
+    Returns whether the segment from (x1, y1) to (x2, y2) hits a wall of the map.
+
+    Before the exact orientation tests, segments outside of the bounding
+    box of all walls are rejected right away and of the candidate walls
+    only those whose bounding box overlaps the one of the segment are tested.
+    """
+    low_x, high_x = (x1, x2) if x1 <= x2 else (x2, x1)
+    low_y, high_y = (y1, y2) if y1 <= y2 else (y2, y1)
+    bounds = map.wall_bounds
+    if high_x < bounds[0] or high_y < bounds[1] or low_x > bounds[2] or low_y > bounds[3]:
+        if stats.enabled:
+            stats.count("segments_tested")
+            stats.count("segments_outside_walls")
+        return False
+    candidates = map.index.candidates(x1, y1, x2, y2)
+    if len(candidates) < BATCH_MIN_PAIRS:
+        boxes = map.box_list
+        tested = []
+        for i in candidates:
+            box = boxes[i]
+            if box[0] <= high_x and box[1] <= high_y and box[2] >= low_x and box[3] >= low_y:
+                tested.append(i)
+    else:
+        boxes = map.boxes[candidates]
+        overlap = ((boxes[:, 0] <= high_x) & (boxes[:, 1] <= high_y) &
+                   (boxes[:, 2] >= low_x) & (boxes[:, 3] >= low_y))
+        tested = np.asarray(candidates)[overlap]
+    if stats.enabled:
+        stats.count("segments_tested")
+        stats.count("walls_tested", len(tested))
+        stats.count("walls_rejected_by_box", len(candidates) - len(tested))
+    if not len(tested):
+        return False
+    if len(tested) < BATCH_MIN_PAIRS:
+        # only the tested walls become points
+        segment = (Point(x1, y1), Point(x2, y2))
+        collision = any(do_intersect(segment, (Point(x3, y3), Point(x4, y4)))
+                        for x3, y3, x4, y4 in map.walls[tested].tolist())
+    else:
+        collision = batch_intersect([(x1, y1, x2, y2)], map.walls[tested]).any()
+    if collision and stats.enabled:
+        stats.count("collision_hits")
+    return collision
+
+
+def simulate(track, steps, approximate=False, check=True, random_braking=True,
+             generating=False):
+    """
+    Simulates a whole sequence of steps of a track.
+
+    The state is kept in plain integers while stepping and distances are
+    compared squared, the new positions and acceleration vectors are only
+    turned into points and vectors once at the end. Braking is a loop,
+    so no track is too long for the simulation.
+
+    Returns False if the track stopped, i.e. braked or collided, and True
+    if all steps were taken.
+
+    track: the track to continue
+    steps: iterable of acceleration vectors or, if approximate is set,
+           of positions to approximate. It is consumed lazily, so the
+           vectors may depend on random numbers drawn in between.
+    approximate: if set the steps are positions and every step accelerates
+                 as far as possible towards the next of them
+    check: if set the track brakes near the target and collisions are checked
+    random_braking: if set the track randomly brakes the nearer it gets
+                    to the target
+    generating: if set the track is reset when it collides
+    """
+    map = track.map
+    max_acceleration = map.max_acceleration
+    brake_distance = max_acceleration * 2.5
+    brake_distance_squared = brake_distance * brake_distance
+    euclidean = map.distance_field is None
+    target_x, target_y = map.target
+    x, y = track.positions[-1]
+    velocity_x, velocity_y = track.velocity_vector
+    random = track.rng.random
+    xs, ys, accelerations_x, accelerations_y = [], [], [], []
+    running = True
+    for step in steps:
+        if approximate:
+            acceleration_x = step[0] - x - velocity_x
+            acceleration_y = step[1] - y - velocity_y
+        else:
+            acceleration_x, acceleration_y = step
+        acceleration_x, acceleration_y = _limit(acceleration_x, acceleration_y,
+                                                max_acceleration)
+        velocity_x += acceleration_x
+        velocity_y += acceleration_y
+        last_x, last_y = x, y
+        x += velocity_x
+        y += velocity_y
+        xs.append(x)
+        ys.append(y)
+        accelerations_x.append(acceleration_x)
+        accelerations_y.append(acceleration_y)
+        if not check:
+            continue
+        # brake if near enough to the target
+        if euclidean:
+            distance_squared = (x - target_x) * (x - target_x) + (y - target_y) * (y - target_y)
+            near = distance_squared < brake_distance_squared
+        else:
+            distance = map.target_distance(Point(x, y))
+            near = distance < brake_distance
+        if near and random_braking:
+            if euclidean:
+                distance = sqrt(distance_squared)
+            if ((-1/brake_distance) * distance + 1) > random():
+                while True:
+                    acceleration_x, acceleration_y = _limit(-velocity_x, -velocity_y,
+                                                            max_acceleration)
+                    velocity_x += acceleration_x
+                    velocity_y += acceleration_y
+                    x += velocity_x
+                    y += velocity_y
+                    xs.append(x)
+                    ys.append(y)
+                    accelerations_x.append(acceleration_x)
+                    accelerations_y.append(acceleration_y)
+                    # stopped, or the acceleration is too small to brake any further
+                    if not (velocity_x or velocity_y) or not (acceleration_x or acceleration_y):
+                        break
+                running = False
+                break
+        elif _collides(map, last_x, last_y, x, y):
+            if generating:
+                track.__init__(map, track.rng)
+                x, y = map.start
+                velocity_x = velocity_y = 0
+                xs, ys, accelerations_x, accelerations_y = [], [], [], []
+            else:
+                track.collision = True
+                running = False
                 break
+    track.positions.extend([Point(x, y) for x, y in zip(xs, ys)])
+    track.acceleration_vectors.extend([Vector(x, y) for x, y
+                                       in zip(accelerations_x, accelerations_y)])
+    track.velocity_vector = Vector(velocity_x, velocity_y)
+    return running
+
+
+def _limit_batch(vectors, max_acceleration):
+    """Vectorized version of _limit for an (n, 2) array of vectors."""
+    squared = (vectors * vectors).sum(axis=1)
+    over = squared > max_acceleration * max_acceleration
+    if over.any():
+        vectors = vectors.copy()
+        length = np.sqrt(squared[over])[:, None]
+        vectors[over] = (vectors[over] * 1/length * max_acceleration).astype(np.int64)
+    return vectors
+
+
+def _collide_batch(map, segments):
+    """
+    Vectorized version of _collides.
+
+    Segments outside of the bounding box of all walls are rejected first,
+    the candidate walls of the others come from the spatial index, or on
+    maps with few walls from comparing all bounding boxes, and only the
+    candidates whose box overlaps the one of the segment are tested. Every
+    pair of a segment and a wall is tested at most once.
+
+    Returns a boolean mask which is true for the segments hitting a wall.
+
+    segments: (n, 4) integer array of segments
+    """
+    hits = np.zeros(len(segments), dtype=bool)
+    boxes = map.boxes
+    if not len(segments) or not len(boxes):
+        return hits
+    low = np.minimum(segments[:, :2], segments[:, 2:])
+    high = np.maximum(segments[:, :2], segments[:, 2:])
+    bounds = map.wall_bounds
+    inside = np.flatnonzero((high[:, 0] >= bounds[0]) & (high[:, 1] >= bounds[1]) &
+                            (low[:, 0] <= bounds[2]) & (low[:, 1] <= bounds[3]))
+    if len(boxes) > BATCH_BOX_WALLS:
+        segment_rows, wall_rows = map.index.candidate_pairs(segments[inside])
+        # a wall spanning several cells of a segment is a candidate only once
+        pairs = np.unique(segment_rows * len(boxes) + wall_rows)
+        segment_rows = inside[pairs // len(boxes)]
+        wall_rows = pairs % len(boxes)
+        candidate_count = len(wall_rows)
+        candidates = boxes[wall_rows]
+        overlap = ((candidates[:, 0] <= high[segment_rows, 0]) &
+                   (candidates[:, 1] <= high[segment_rows, 1]) &
+                   (candidates[:, 2] >= low[segment_rows, 0]) &
+                   (candidates[:, 3] >= low[segment_rows, 1]))
+        segment_rows = segment_rows[overlap]
+        wall_rows = wall_rows[overlap]
+    else:
+        overlap = ((boxes[None, :, 0] <= high[inside, None, 0]) &
+                   (boxes[None, :, 1] <= high[inside, None, 1]) &
+                   (boxes[None, :, 2] >= low[inside, None, 0]) &
+                   (boxes[None, :, 3] >= low[inside, None, 1]))
+        segment_rows, wall_rows = np.nonzero(overlap)
+        segment_rows = inside[segment_rows]
+        candidate_count = overlap.size
+    collisions = intersect_pairs(segments[segment_rows], map.walls[wall_rows])
+    hits[segment_rows[collisions]] = True
+    if stats.enabled:
+        stats.count("segments_tested", len(segments))
+        stats.count("segments_outside_walls", len(segments) - len(inside))
+        stats.count("walls_tested", len(wall_rows))
+        stats.count("walls_rejected_by_box", candidate_count - len(wall_rows))
+        stats.count("collision_hits", int(hits.sum()))
+    return hits
+
+
+def simulate_batch(map, positions, velocities, steps, lengths, random_braking=True,
+                   rng=None):
+    """
+    Lockstep version of simulate with approximate and check set, which
+    advances many tracks at once with a few array operations per time step.
+
+    Every time step accelerates all running tracks towards their next
+    position, lets the tracks near the target randomly start braking and
+    tests the moves of the others against the walls together. Tracks are
+    retired once they collided, stopped braking or ran out of positions.
+    The random numbers for braking are drawn from the numpy generator of
+    the stream, so the tracks differ from simulate for the same seed, but
+    not in distribution.
+
+    Returns the arrays (positions, accelerations, counts, velocities,
+    collisions): the new positions and acceleration vectors of each track,
+    padded with zeros, the number of new positions of each track, the final
+    velocity vectors and the collision flags.
+
+    map: the map of the tracks
+    positions: (n, 2) array of the current positions
+    velocities: (n, 2) array of the current velocity vectors
+    steps: (n, max_steps, 2) array of the positions to approximate,
+           padded with anything
+    lengths: (n,) array of the number of positions each track approximates
+    random_braking: if set the tracks randomly brake the nearer they get
+                    to the target
+    rng: the RandomStream used for braking, the default stream if not given
+    """
+    if rng is None:
+        rng = default_stream
+    max_acceleration = map.max_acceleration
+    brake_distance = max_acceleration * 2.5
+    euclidean = map.distance_field is None
+    target = np.array(map.target, dtype=np.int64)
+    position = np.array(positions, dtype=np.int64).reshape(-1, 2)
+    velocity = np.array(velocities, dtype=np.int64).reshape(-1, 2)
+    steps = np.asarray(steps, dtype=np.int64).reshape(len(position), -1, 2)
+    lengths = np.asarray(lengths, dtype=np.int64)
+    size = len(position)
+    new_positions = np.zeros((size, steps.shape[1] + 1, 2), dtype=np.int64)
+    new_accelerations = np.zeros_like(new_positions)
+    counts = np.zeros(size, dtype=np.int64)
+    collisions = np.zeros(size, dtype=bool)
+    braking = np.zeros(size, dtype=bool)
+    active = np.flatnonzero(lengths > 0)
+    while len(active):
+        stats.count("batch_steps")
+        brakes = braking[active]
+        count = counts[active]
+        # tracks which don't brake took one step per position so far
+        goals = steps[active, np.minimum(count, steps.shape[1] - 1)]
+        acceleration = np.where(brakes[:, None], -velocity[active],
+                                goals - position[active] - velocity[active])
+        acceleration = _limit_batch(acceleration, max_acceleration)
+        velocity[active] += acceleration
+        last = position[active]
+        position[active] = last + velocity[active]
+        if count.max() >= new_positions.shape[1]:
+            new_positions = np.concatenate((new_positions, np.zeros_like(new_positions)),
+                                           axis=1)
+            new_accelerations = np.concatenate(
+                (new_accelerations, np.zeros_like(new_accelerations)), axis=1)
+        new_positions[active, count] = position[active]
+        new_accelerations[active, count] = acceleration
+        counts[active] = count + 1
+        # stopped, or the acceleration is too small to brake any further
+        retired = brakes & (~velocity[active].any(axis=1) | ~acceleration.any(axis=1))
+
+        moving = np.flatnonzero(~brakes)
+        rows = active[moving]
+        if euclidean:
+            differences = position[rows] - target
+            distances_squared = (differences * differences).sum(axis=1)
+            near = distances_squared < brake_distance * brake_distance
+        else:
+            distances = map.target_distances(position[rows])
+            near = distances < brake_distance
+        checked = np.ones(len(rows), dtype=bool)
+        if random_braking:
+            checked = ~near
+            if near.any():
+                if euclidean:
+                    distance = np.sqrt(distances_squared[near])
+                else:
+                    distance = distances[near]
+                chance = (-1/brake_distance) * distance + 1
+                start = chance > rng.numpy.random(len(distance))
+                braking[rows[near][start]] = True
+        segments = np.hstack((last[moving[checked]], position[rows[checked]]))
+        hits = _collide_batch(map, segments)
+        collisions[rows[checked][hits]] = True
+        finished = collisions[rows] | ((counts[rows] >= lengths[rows]) & ~braking[rows])
+        retired[moving[finished]] = True
+        active = active[~retired]
+    return new_positions, new_accelerations, counts, velocity, collisions
+
+
+def export_track(track):
+    """
+    Converts a track into plain tuples which can be sent between processes
+    without the map.
+
+    track: the track to convert
+    """
+    return (tuple(track.positions), tuple(track.acceleration_vectors),
+            track.velocity_vector, track.collision)
+
+
+def import_track(map, state):
+    """
+    Rebuilds a track exported with export_track.
+
+    map: the map of the track
+    state: the exported track
+    """
+    positions, acceleration_vectors, velocity_vector, collision = state
+    track = Track(map)
+    track.positions = [Point(*p) for p in positions]
+    track.acceleration_vectors = [Vector(*a) for a in acceleration_vectors]
+    track.velocity_vector = Vector(*velocity_vector)
+    track.collision = collision
+    return track
+
+
+def replay_track(map, acceleration_vectors, collision=False):
+    """
+    Rebuilds a track from its acceleration vectors alone.
+
+    The velocities are the running sum of the accelerations and the
+    positions the running sum of the velocities, so no step by step
+    simulation is necessary.
+
+    map: the map of the track
+    acceleration_vectors: (n, 2) array like, starting with the
+                          initial zero acceleration
+    collision: the collision flag of the track
+    """
+    accelerations = np.asarray(acceleration_vectors, dtype=np.int64).reshape(-1, 2)
+    velocities = np.cumsum(accelerations, axis=0)
+    positions = np.cumsum(velocities, axis=0) + map.start
+    track = Track(map)
+    track.positions = [Point(*p) for p in positions.tolist()]
+    track.acceleration_vectors = [Vector(*a) for a in accelerations.tolist()]
+    if len(velocities):
+        track.velocity_vector = Vector(*velocities[-1].tolist())
+    track.collision = bool(collision)
+    return track
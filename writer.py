@@ -0,0 +1,97 @@
+import multiprocessing
+import queue
+from collections import namedtuple
+from contexttimer import Timer
+from graphics import save_svg
+
+# the only part of a track the plots need
+TrackSnapshot = namedtuple("TrackSnapshot", ["positions"])
+
+
+def snapshot(tracks):
+    """
+    Copies the positions of tracks, so they can be plotted
+    while the tracks keep evolving.
+
+    tracks: the tracks to copy
+    """
+    return [tuple(track.positions) for track in tracks]
+
+
+def _write(map, out_directory, jobs, durations):
+    """
+    Main loop of the writer process.
+
+    map: the map to plot
+    out_directory: folder in which to save the SVG files
+    jobs: queue of (filename, positions, grade) tuples, None stops the writer
+    durations: queue receiving the duration of every written file
+    """
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        filename, positions, grade = job
+        with Timer() as write_timer:
+            save_svg(filename, map, [TrackSnapshot(p) for p in positions],
+                     grade, out_directory=out_directory)
+        durations.put(write_timer.elapsed)
+
+
+class BackgroundWriter():
+    """
+    Writes SVG plots in a separate process,
+    so the evolution doesn't wait for them.
+    """
+
+    def __init__(self, map, out_directory, queue_size=2, block=False):
+        """
+        Starts the writer process.
+
+        map: the map to plot, it is handed to the writer only once
+        out_directory: folder in which to save the SVG files
+        queue_size: the number of plots which may wait to be written
+        block: if set save waits for a free slot when the writer falls behind,
+               otherwise the plot is dropped
+        """
+        self.block = block
+        self.dropped = 0
+        self.jobs = multiprocessing.Queue(max(1, int(queue_size)))
+        self.durations = multiprocessing.Queue()
+        self.process = multiprocessing.Process(
+            target=_write, args=(map, out_directory, self.jobs, self.durations),
+            daemon=True)
+        self.process.start()
+
+    def save(self, filename, tracks, grade=""):
+        """
+        Queues a plot of the tracks. Returns False if the plot was dropped.
+
+        filename: the name of the SVG file
+        tracks: the tracks to plot
+        grade: optional grade printed on the plot
+        """
+        job = (filename, snapshot(tracks), grade)
+        if self.block:
+            self.jobs.put(job)
+            return True
+        try:
+            self.jobs.put_nowait(job)
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    def finished(self):
+        """Returns the durations of the files written since the last call."""
+        durations = []
+        while True:
+            try:
+                durations.append(self.durations.get_nowait())
+            except queue.Empty:
+                return durations
+
+    def close(self):
+        """Waits until all queued plots are written and stops the writer."""
+        self.jobs.put(None)
+        self.process.join()